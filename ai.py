@@ -1,6 +1,54 @@
+import time
+
+from bitboard import PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING
 from chess import BLACK, WHITE
+from tablebase import Tablebases
+from tt import TranspositionTable, EXACT, LOWER, UPPER
 
 INF = 10 ** 9
+# Сторона без ходов проиграла: её оценка -(MATE - ply), где ply --- полуход
+# поиска. Оценка мата остаётся внутри окна (-INF, INF), а ближний мат
+# оценивается выше дальнего
+MATE = INF - 1000
+# Размер таблицы позиций, общей для всех ходов ИИ
+TT_SIZE_MB = 16
+# Наибольшая глубина итеративного углубления
+MAX_DEPTH = 64
+# Через сколько узлов проверять, не пора ли остановить поиск
+CHECK_INTERVAL = 256
+# Досчитывать взятия на горизонте поиска (см. quiescence)
+QUIESCENCE = True
+# Наибольшая глубина досчёта: под шахом перебираются все ходы, и серия
+# шахов без ограничения могла бы упереться в предел рекурсии
+QUIESCENCE_MAX_PLY = 16
+
+# Алгоритмы поиска для iterative_deepening
+MINIMAX = 'minimax'
+NEGAMAX = 'negamax'
+SEARCH_METHODS = (MINIMAX, NEGAMAX)
+# Lazy SMP: negamax в нескольких процессах с общей таблицей позиций
+# (parallel.LazySMPSearch). Выбирается в main.AI_SEARCH
+SMP = 'smp'
+# Начиная с этой глубины negamax ищет в окне ASPIRATION_WINDOW
+# вокруг оценки прошлой итерации (см. aspiration_search). После
+# ASPIRATION_RETRIES выходов за окно ищется с полным окном: скачок оценки
+# до мата иначе стоил бы десятков повторных поисков
+ASPIRATION_DEPTH = 3
+ASPIRATION_RETRIES = 2
+
+# Отсечение нулевым ходом в negamax: если даже после пропуска хода
+# оценка не ниже beta, узел отсекается. Поиск после нулевого хода
+# сокращается на NULL_MOVE_REDUCTION полуходов
+NULL_MOVE = True
+NULL_MOVE_MIN_DEPTH = 3
+NULL_MOVE_REDUCTION = 2
+# Сокращение поздних ходов в negamax: тихие ходы начиная с номера
+# LMR_MIN_MOVE в упорядоченном списке ищутся на LMR_REDUCTION полуходов
+# мельче и перепроверяются на полную глубину, если оказались лучше alpha
+LMR = True
+LMR_MIN_DEPTH = 3
+LMR_MIN_MOVE = 3
+LMR_REDUCTION = 1
 
 PAWN_EVAL_WHITE = [
     [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
@@ -113,6 +161,40 @@ PIECE_COSTS = {
 }
 
 
+# Оценки в таблицах кратны 0.5, поэтому в целых единицах EVAL_SCALE
+# они считаются точно: evaluate(game) == evaluate_board(...) * EVAL_SCALE
+EVAL_SCALE = 2
+# Полуширина начального окна (полпешки) для aspiration_search
+ASPIRATION_WINDOW = 5 * EVAL_SCALE
+# Запас (две пешки) при отсечении взятий, которые даже с учётом
+# стоимости жертвы не могут поднять оценку до alpha (см. quiescence)
+DELTA_MARGIN = 20 * EVAL_SCALE
+
+KIND_CHARS = {
+    PAWN: 'P',
+    KNIGHT: 'N',
+    BISHOP: 'B',
+    ROOK: 'R',
+    QUEEN: 'Q',
+    KING: 'K'
+}
+
+
+def make_eval_tables():
+    """Таблицы tables[color][kind][sq] со стоимостью фигуры и оценкой её
+    положения в клетке sq = row * 8 + col (для чёрных со знаком минус)"""
+    tables = []
+    for color in (WHITE, BLACK):
+        sign = -1 if color == BLACK else 1
+        tables.append([])
+        for kind in range(6):
+            char = KIND_CHARS[kind]
+            evals = PIECE_EVALS[char][color]
+            tables[-1].append([sign * int(round((PIECE_COSTS[char] + evals[sq // 8][sq % 8]) * EVAL_SCALE))
+                               for sq in range(64)])
+    return tables
+
+
 def get_piece_eval(piece, pos):
     if piece is None:
         return 0
@@ -165,42 +247,375 @@ def evaluate_board(board):
     return totalEvaluation
 
 
-def minimax_eval(depth_left, game, alpha, beta, is_maximising_player):
+EVAL_TABLES = make_eval_tables()
+
+
+TRANSPOSITION_TABLE = TranspositionTable(TT_SIZE_MB)
+
+# Таблицы окончаний (строятся командой python tbgen.py); без них поиск
+# работает как обычно
+TABLEBASES = Tablebases()
+# Выигрыш по таблицам: больше любой оценки позиции, но меньше мата,
+# найденного самим поиском
+TB_WIN = INF // 2
+
+
+def probe_tablebase(game):
+    """Оценка позиции по таблицам окончаний с точки зрения ходящей стороны
+    (чем быстрее мат, тем она больше) или None, если позиции нет в таблицах"""
+    value = TABLEBASES.probe(game)
+    if value is None:
+        return None
+    wdl, plies = value
+    return wdl * (TB_WIN - plies)
+
+
+def init_evaluation(game):
+    """Включить на доске пошаговый пересчёт оценки по EVAL_TABLES"""
+    if game.eval_tables is not EVAL_TABLES:
+        game.set_evaluation(EVAL_TABLES)
+
+
+def evaluate(game):
+    """Оценка позиции в единицах 1 / EVAL_SCALE. Доска должна быть
+    подготовлена init_evaluation"""
+    return game.evaluation
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class SearchControl:
+    """Ограничение поиска по времени. Когда время вышло или вызван stop(),
+    check() бросает SearchTimeout, и поиск прерывается"""
+
+    def __init__(self, time_limit=None):
+        self.set_time_limit(time_limit)
+        self.stopped = False
+        self.nodes = 0
+        # Пока False, время не проверяется (первая глубина iterative_deepening)
+        self.timed = True
+
+    def set_time_limit(self, time_limit):
+        """Ограничить поиск time_limit секундами от текущего момента (None ---
+        без ограничения). Можно вызывать из другого потока во время поиска"""
+        self.deadline = None if time_limit is None else time.perf_counter() + time_limit
+
+    def stop(self):
+        self.stopped = True
+
+    def timed_out(self):
+        deadline = self.deadline
+        return self.stopped or (self.timed and deadline is not None and time.perf_counter() >= deadline)
+
+    def check(self):
+        self.nodes += 1
+        if self.nodes % CHECK_INTERVAL == 0:
+            if self.timed_out():
+                raise SearchTimeout()
+
+
+# Ценность фигуры каждого вида для упорядочивания взятий (MVV-LVA)
+KIND_COSTS = [PIECE_COSTS[KIND_CHARS[kind]] for kind in range(6)]
+
+# Приоритеты групп ходов при упорядочивании
+TT_MOVE_SCORE = 1 << 40
+CAPTURE_SCORE = 1 << 32
+KILLER_SCORE = 1 << 31
+HISTORY_LIMIT = 1 << 30
+
+
+def mvv_lva(board, move):
+    """Выигрыш материала от взятия или превращения и порядок его проверки:
+    самая ценная жертва, затем самый дешёвый нападающий. 0 для тихих ходов"""
+    row, col, row1, col1 = move
+    piece = board[row][col]
+    victim = board[row1][col1]
+
+    value = 0
+    if victim is not None:
+        value = KIND_COSTS[victim.kind]
+    if piece.kind == PAWN and (row1 == 0 or row1 == 7):
+        value += KIND_COSTS[QUEEN] - KIND_COSTS[PAWN]
+    if value:
+        return value * 1024 - KIND_COSTS[piece.kind]
+    return 0
+
+
+def get_gain(board, move):
+    """Наибольшее изменение материала от взятия или превращения, в единицах оценки"""
+    row, col, row1, col1 = move
+    victim = board[row1][col1]
+
+    value = 0
+    if victim is not None:
+        value = KIND_COSTS[victim.kind]
+    if board[row][col].kind == PAWN and (row1 == 0 or row1 == 7):
+        value += KIND_COSTS[QUEEN] - KIND_COSTS[PAWN]
+    return value * EVAL_SCALE
+
+
+# Начиная с этой глубины ходы с равным приоритетом (в основном тихие
+# без истории) упорядочиваются по оценке позиции после хода. Оценки
+# всех детей считаются одним вызовом batch_eval.evaluate_children;
+# без numpy этот шаг пропускается
+EVAL_ORDERING_DEPTH = 3
+_batch_eval = None
+
+
+def child_evaluations(game, moves):
+    """Оценки позиций после ходов moves с точки зрения ходящей стороны
+    или None, если numpy не установлен"""
+    global _batch_eval
+    if _batch_eval is None:
+        try:
+            # batch_eval импортирует ai, поэтому импорт отложен
+            import batch_eval
+            _batch_eval = batch_eval
+        except ImportError:
+            _batch_eval = False
+    if not _batch_eval or not moves:
+        return None
+    values = _batch_eval.evaluate_children(game, moves).tolist()
+    if game.color == BLACK:
+        values = [-value for value in values]
+    return values
+
+
+class MoveOrdering:
+    """Порядок перебора ходов: сначала ход из таблицы позиций, затем взятия
+    и превращения по MVV-LVA (самая ценная жертва, самый дешёвый нападающий),
+    затем ходы-убийцы этого полухода, остальные --- по таблице истории"""
+
+    def __init__(self):
+        # Два последних тихих хода, вызвавших отсечение, для каждого полухода поиска
+        self.killers = []
+        # history[from * 64 + to] --- насколько часто тихий ход вызывал отсечение
+        self.history = [0] * (64 * 64)
+
+    def new_search(self):
+        self.killers = []
+        # Старая статистика полезна, но новая важнее
+        self.history = [x // 2 for x in self.history]
+
+    def get_killers(self, ply):
+        while len(self.killers) <= ply:
+            self.killers.append([None, None])
+        return self.killers[ply]
+
+    def order(self, game, moves, tt_move=None, depth_left=0):
+        board = game.board
+        killers = self.get_killers(game.search_ply)
+        history = self.history
+        evals = child_evaluations(game, moves) if depth_left >= EVAL_ORDERING_DEPTH else None
+
+        def score(move):
+            if move == tt_move:
+                return TT_MOVE_SCORE
+
+            value = mvv_lva(board, move)
+            if value:
+                return CAPTURE_SCORE + value
+
+            if move == killers[0]:
+                return KILLER_SCORE + 1
+            if move == killers[1]:
+                return KILLER_SCORE
+            row, col, row1, col1 = move
+            return history[(row * 8 + col) * 64 + row1 * 8 + col1]
+
+        if evals is None:
+            moves.sort(key=score, reverse=True)
+        else:
+            keys = {move: (score(move), value) for move, value in zip(moves, evals)}
+            moves.sort(key=keys.__getitem__, reverse=True)
+        return moves
+
+    def add_cutoff(self, game, move, depth_left):
+        """Запомнить тихий ход move, вызвавший отсечение"""
+        row, col, row1, col1 = move
+        if game.board[row1][col1] is not None:
+            return
+
+        killers = self.get_killers(game.search_ply)
+        if killers[0] != move:
+            killers[1] = killers[0]
+            killers[0] = move
+
+        index = (row * 8 + col) * 64 + row1 * 8 + col1
+        self.history[index] += depth_left * depth_left
+        if self.history[index] >= HISTORY_LIMIT:
+            self.history = [x // 2 for x in self.history]
+
+
+MOVE_ORDERING = MoveOrdering()
+
+
+def quiescence(game, alpha, beta, is_maximising_player, control=None, ply=0):
+    """Оценка позиции на горизонте с досчётом взятий: сторона, которая
+    ходит, может взять фигуру или остановиться с текущей оценкой
+    (stand pat). Под шахом перебираются все ходы. ply --- глубина
+    досчёта; после QUIESCENCE_MAX_PLY возвращается оценка позиции"""
+    if control is not None:
+        control.check()
+
+    if ply >= QUIESCENCE_MAX_PLY:
+        return min(max(game.evaluation, alpha), beta)
+
+    board = game.board
+    in_check = game.is_check()
+    if in_check:
+        moves = game.legal_moves()
+        stand_pat = None
+        if not moves:
+            score = MATE - game.search_ply
+            score = -score if is_maximising_player else score
+            return min(max(score, alpha), beta)
+    else:
+        moves = game.legal_captures()
+        moves.sort(key=lambda move: mvv_lva(board, move), reverse=True)
+        stand_pat = game.evaluation
+
+    if is_maximising_player:
+        if stand_pat is not None:
+            if stand_pat >= beta:
+                return beta
+            if stand_pat > alpha:
+                alpha = stand_pat
+
+        for move in moves:
+            # Даже выиграв жертву, не поднять оценку до alpha
+            if stand_pat is not None and stand_pat + get_gain(board, move) + DELTA_MARGIN <= alpha:
+                continue
+
+            game.push(*move)
+            score = quiescence(game, alpha, beta, False, control, ply + 1)
+            game.pop()
+
+            if score >= beta:
+                return beta
+            if score > alpha:
+                alpha = score
+        return alpha
+    else:
+        if stand_pat is not None:
+            if stand_pat <= alpha:
+                return alpha
+            if stand_pat < beta:
+                beta = stand_pat
+
+        for move in moves:
+            if stand_pat is not None and stand_pat - get_gain(board, move) - DELTA_MARGIN >= beta:
+                continue
+
+            game.push(*move)
+            score = quiescence(game, alpha, beta, True, control, ply + 1)
+            game.pop()
+
+            if score <= alpha:
+                return alpha
+            if score < beta:
+                beta = score
+        return beta
+
+
+def minimax_eval(depth_left, game, alpha, beta, is_maximising_player, tt=None, control=None, ordering=None):
+    score = probe_tablebase(game)
+    if score is not None:
+        if game.color == BLACK:
+            score = -score
+        return min(max(score, alpha), beta)
+
     if depth_left == 0:
-        return evaluate_board(game.get_board())
+        if QUIESCENCE:
+            return quiescence(game, alpha, beta, is_maximising_player, control)
+        if control is not None:
+            control.check()
+        return game.evaluation
         # if is_maximising_player:
         #     return evaluate_board(game.get_board())
         # else:
         #     return evaluate_board(game.get_board()) * -1
 
-    new_game_moves = game.moves_without_check()
+    if control is not None:
+        control.check()
+
+    key = game.zobrist_key()
+    tt_move = None
+    if tt is not None:
+        entry = tt.probe(key)
+        if entry is not None:
+            depth, score, bound, tt_move = entry
+            if depth >= depth_left:
+                if bound == EXACT:
+                    return min(max(score, alpha), beta)
+                if bound == LOWER and score >= beta:
+                    return beta
+                if bound == UPPER and score <= alpha:
+                    return alpha
+
+    new_game_moves = game.legal_moves()
+    if ordering is not None:
+        ordering.order(game, new_game_moves, tt_move, depth_left)
+
+    alpha_start, beta_start = alpha, beta
+    best_move = None
 
     if is_maximising_player:
         for move in new_game_moves:
-            game.make_move(*move, True)
-            score = minimax_eval(depth_left - 1, game, alpha, beta, not is_maximising_player)
-            game.undo(True)
+            game.push(*move)
+            score = minimax_eval(depth_left - 1, game, alpha, beta, not is_maximising_player, tt, control, ordering)
+            game.pop()
 
             if score >= beta:
+                if tt is not None:
+                    tt.store(key, depth_left, beta, LOWER, move)
+                if ordering is not None:
+                    ordering.add_cutoff(game, move, depth_left)
                 return beta
             if score > alpha:
                 alpha = score
+                best_move = move
+
+        if tt is not None:
+            tt.store(key, depth_left, alpha, EXACT if alpha > alpha_start else UPPER, best_move)
         return alpha
     else:
         for move in new_game_moves:
-            game.make_move(*move, True)
-            score = minimax_eval(depth_left - 1, game, alpha, beta, not is_maximising_player)
-            game.undo(True)
+            game.push(*move)
+            score = minimax_eval(depth_left - 1, game, alpha, beta, not is_maximising_player, tt, control, ordering)
+            game.pop()
 
             if score <= alpha:
+                if tt is not None:
+                    tt.store(key, depth_left, alpha, UPPER, move)
+                if ordering is not None:
+                    ordering.add_cutoff(game, move, depth_left)
                 return alpha
             if score < beta:
                 beta = score
+                best_move = move
+
+        if tt is not None:
+            tt.store(key, depth_left, beta, EXACT if beta < beta_start else LOWER, best_move)
         return beta
 
 
-def minimax_root(depth_left, game, is_maximising_player):
-    new_game_moves = game.moves_without_check()
+def minimax_root(depth_left, game, is_maximising_player, tt=None, control=None, first_move=None, ordering=None):
+    """Лучший ход на глубину depth_left. Если tt не передана,
+    используется общая таблица TRANSPOSITION_TABLE. Ход first_move
+    (например, лучший на прошлой глубине) проверяется первым"""
+    if tt is None:
+        tt = TRANSPOSITION_TABLE
+
+    init_evaluation(game)
+    new_game_moves = game.legal_moves()
+    if ordering is not None:
+        ordering.order(game, new_game_moves, first_move, depth_left)
+    elif first_move in new_game_moves:
+        new_game_moves.remove(first_move)
+        new_game_moves.insert(0, first_move)
     best_move_found = new_game_moves[0]
 
     if is_maximising_player:
@@ -209,9 +624,13 @@ def minimax_root(depth_left, game, is_maximising_player):
         best_move = INF
 
     for move in new_game_moves:
-        game.make_move(*move, True)
-        value = minimax_eval(depth_left - 1, game, -INF, INF, not is_maximising_player)
-        game.undo()
+        # Ход не лучше уже найденного отсекается так же, как в minimax_eval
+        game.push(*move)
+        if is_maximising_player:
+            value = minimax_eval(depth_left - 1, game, best_move, INF, False, tt, control, ordering)
+        else:
+            value = minimax_eval(depth_left - 1, game, -INF, best_move, True, tt, control, ordering)
+        game.pop()
 
         if value > best_move and is_maximising_player:
             best_move = value
@@ -221,3 +640,227 @@ def minimax_root(depth_left, game, is_maximising_player):
             best_move_found = move
 
     return best_move_found
+
+
+def probe_negamax(tt, key, white):
+    """Запись таблицы позиций с оценкой с точки зрения ходящей стороны.
+    В таблице оценки хранятся с точки зрения белых, как в minimax_eval"""
+    entry = tt.probe(key)
+    if entry is None or white:
+        return entry
+    depth, score, bound, move = entry
+    if bound != EXACT:
+        bound = LOWER if bound == UPPER else UPPER
+    return depth, -score, bound, move
+
+
+def store_negamax(tt, key, white, depth, score, bound, move):
+    if not white:
+        score = -score
+        if bound != EXACT:
+            bound = LOWER if bound == UPPER else UPPER
+    tt.store(key, depth, score, bound, move)
+
+
+def has_pieces(game, color):
+    """Есть ли у стороны фигуры, кроме короля и пешек. Без них нулевой ход
+    опасен: в пешечных окончаниях часто цугцванг"""
+    pieces = game.bitboards.pieces[color]
+    return bool(pieces[KNIGHT] | pieces[BISHOP] | pieces[ROOK] | pieces[QUEEN])
+
+
+def negamax(depth_left, game, alpha, beta, tt=None, control=None, ordering=None, pv=None, allow_null=True):
+    """Оценка позиции с точки зрения ходящей стороны (в отличие от
+    minimax_eval, где оценка всегда с точки зрения белых). Первый ход
+    ищется с полным окном, остальные --- с нулевым и перепроверяются,
+    если оказались лучше (principal variation search). Если передан
+    список pv, в него записывается главный вариант. allow_null=False
+    запрещает нулевой ход (два нулевых хода подряд бессмысленны)"""
+    if pv is not None:
+        del pv[:]
+
+    white = game.color == WHITE
+    score = probe_tablebase(game)
+    if score is not None:
+        return min(max(score, alpha), beta)
+
+    if depth_left <= 0:
+        if QUIESCENCE:
+            if white:
+                return quiescence(game, alpha, beta, True, control)
+            return -quiescence(game, -beta, -alpha, False, control)
+        if control is not None:
+            control.check()
+        return game.evaluation if white else -game.evaluation
+
+    if control is not None:
+        control.check()
+
+    key = game.zobrist_key()
+    is_pv_node = beta - alpha > 1
+    tt_move = None
+    if tt is not None:
+        entry = probe_negamax(tt, key, white)
+        if entry is not None:
+            depth, score, bound, tt_move = entry
+            # В узлах главного варианта не отсекаем, чтобы не обрывать pv
+            if depth >= depth_left and not is_pv_node:
+                if bound == EXACT:
+                    return min(max(score, alpha), beta)
+                if bound == LOWER and score >= beta:
+                    return beta
+                if bound == UPPER and score <= alpha:
+                    return alpha
+
+    new_game_moves = game.legal_moves()
+    # Без ходов позиция проиграна (см. is_checkmate)
+    if not new_game_moves:
+        return min(max(-(MATE - game.search_ply), alpha), beta)
+
+    in_check = game.is_check()
+    if (NULL_MOVE and allow_null and not is_pv_node and not in_check
+            and depth_left >= NULL_MOVE_MIN_DEPTH and has_pieces(game, game.color)):
+        game.push_null()
+        score = -negamax(depth_left - 1 - NULL_MOVE_REDUCTION, game, -beta, -beta + 1, tt, control, ordering,
+                         allow_null=False)
+        game.pop()
+        if score >= beta:
+            return beta
+
+    if ordering is not None:
+        ordering.order(game, new_game_moves, tt_move, depth_left)
+
+    alpha_start = alpha
+    best_move = None
+    child_pv = [] if pv is not None else None
+    board = game.board
+    can_reduce = LMR and not in_check and depth_left >= LMR_MIN_DEPTH
+
+    for i, move in enumerate(new_game_moves):
+        is_quiet = can_reduce and i >= LMR_MIN_MOVE and mvv_lva(board, move) == 0
+        if child_pv is not None:
+            del child_pv[:]
+        game.push(*move)
+        if i == 0:
+            score = -negamax(depth_left - 1, game, -beta, -alpha, tt, control, ordering, child_pv)
+        else:
+            reduced = is_quiet and not game.is_check()
+            if reduced:
+                score = -negamax(depth_left - 1 - LMR_REDUCTION, game, -alpha - 1, -alpha, tt, control, ordering)
+            if not reduced or score > alpha:
+                score = -negamax(depth_left - 1, game, -alpha - 1, -alpha, tt, control, ordering)
+            if alpha < score < beta:
+                score = -negamax(depth_left - 1, game, -beta, -alpha, tt, control, ordering, child_pv)
+        game.pop()
+
+        if score >= beta:
+            # Ход, вызвавший отсечение, --- лучший из найденных: в корне
+            # он нужен, даже если поиск прервут на перепроверке окна
+            if pv is not None:
+                pv[:] = [move] + child_pv
+            if tt is not None:
+                store_negamax(tt, key, white, depth_left, beta, LOWER, move)
+            if ordering is not None:
+                ordering.add_cutoff(game, move, depth_left)
+            return beta
+        if score > alpha:
+            alpha = score
+            best_move = move
+            if pv is not None:
+                pv[:] = [move] + child_pv
+
+    if tt is not None:
+        store_negamax(tt, key, white, depth_left, alpha, EXACT if alpha > alpha_start else UPPER, best_move)
+    return alpha
+
+
+def aspiration_search(depth_left, game, previous_score, tt=None, control=None, ordering=None):
+    """negamax из корня в окне вокруг previous_score. Если оценка вышла
+    за окно, окно расширяется (после ASPIRATION_RETRIES неудач --- до
+    полного) и поиск повторяется.
+    Возвращает (оценка, главный вариант)"""
+    pv = []
+    if previous_score is None or depth_left < ASPIRATION_DEPTH:
+        score = negamax(depth_left, game, -INF, INF, tt, control, ordering, pv)
+        return score, pv
+
+    delta = ASPIRATION_WINDOW
+    alpha, beta = previous_score - delta, previous_score + delta
+    failures = 0
+    while True:
+        score = negamax(depth_left, game, alpha, beta, tt, control, ordering, pv)
+        if score <= alpha and alpha > -INF:
+            failures += 1
+            delta *= 2
+            alpha = previous_score - delta if failures < ASPIRATION_RETRIES else -INF
+        elif score >= beta and beta < INF:
+            failures += 1
+            delta *= 2
+            beta = previous_score + delta if failures < ASPIRATION_RETRIES else INF
+        else:
+            return score, pv
+
+
+def iterative_deepening(game, is_maximising_player, time_limit, max_depth=MAX_DEPTH, tt=None, ordering=None,
+                        method=MINIMAX, control=None, first_depth=1):
+    """Искать на глубину first_depth, first_depth + 1, ... пока не выйдет время
+    time_limit (в секундах) или не будет вызван control.stop().
+    method --- MINIMAX (minimax_root) или NEGAMAX (negamax с окнами
+    aspiration_search; сторона берётся из game.color).
+    Возвращает лучший ход последней полностью просчитанной глубины, эту глубину,
+    число просмотренных узлов и главный вариант. Глубина first_depth
+    просчитывается всегда, если поиск не остановлен через control.stop();
+    если остановлен раньше, возвращается глубина 0 и непросчитанный первый ход.
+    Для позиции из таблиц окончаний ход берётся из них (тоже глубина 0)"""
+    if tt is None:
+        tt = TRANSPOSITION_TABLE
+    if ordering is None:
+        ordering = MOVE_ORDERING
+    tt.new_search()
+    ordering.new_search()
+    init_evaluation(game)
+
+    if control is None:
+        control = SearchControl(time_limit)
+    start_ply = game.search_ply
+    moves = game.legal_moves()
+    best_move = moves[0] if moves else None
+    pv = [best_move]
+
+    # Позиция из таблиц окончаний: ход выбирается по ним без поиска
+    if moves and probe_tablebase(game) is not None:
+        tb_move = TABLEBASES.best_move(game)
+        if tb_move is not None:
+            return tb_move, 0, control.nodes, [tb_move]
+
+    score = None
+
+    def search(depth):
+        nonlocal best_move, pv, score
+        if method == NEGAMAX:
+            score, new_pv = aspiration_search(depth, game, score, tt, control, ordering)
+            # Все ходы ведут к мату: оставляем ход прошлой итерации
+            if new_pv:
+                pv = new_pv
+                best_move = pv[0]
+        else:
+            best_move = minimax_root(depth, game, is_maximising_player, tt, control, best_move, ordering)
+            pv = [best_move]
+
+    # Первую глубину время не ограничивает, только stop()
+    control.timed = False
+    depth = first_depth - 1
+    finished = 0
+    while depth < max_depth:
+        try:
+            search(depth + 1)
+        except SearchTimeout:
+            # Отменить ходы прерванного поиска
+            while game.search_ply > start_ply:
+                game.pop()
+            break
+        depth += 1
+        finished = depth
+        control.timed = True
+
+    return best_move, finished, control.nodes, pv
@@ -0,0 +1,66 @@
+import numpy as np
+
+from ai import EVAL_TABLES, EVAL_SCALE
+from bitboard import QUEEN
+from chess import PAWN_END_ROWS, WHITE, BLACK
+
+# Позиции кодируются массивом (N, 64): 0 --- пустая клетка,
+# иначе 1 + color * 6 + kind, как в chess.Snapshot
+CODE_TABLE = np.zeros((13, 64), dtype=np.int64)
+for _color in (WHITE, BLACK):
+    for _kind in range(6):
+        CODE_TABLE[1 + _color * 6 + _kind] = EVAL_TABLES[_color][_kind]
+
+SQUARE_INDEX = np.arange(64)
+
+
+def encode_board(game):
+    return np.frombuffer(game.to_snapshot().squares, dtype=np.uint8)
+
+
+def encode_boards(games):
+    """Массив (N, 64) с кодами фигур для списка досок"""
+    if not games:
+        return np.zeros((0, 64), dtype=np.uint8)
+    return np.stack([encode_board(game) for game in games])
+
+
+def evaluate_codes(codes):
+    """Оценки позиций (N, 64) в единицах 1 / EVAL_SCALE, как ai.evaluate"""
+    return CODE_TABLE[codes, SQUARE_INDEX].sum(axis=1)
+
+
+def evaluate_batch(games):
+    """Оценки списка досок, совпадающие с ai.evaluate_board"""
+    return evaluate_codes(encode_boards(games)) / EVAL_SCALE
+
+
+def encode_children(game, moves):
+    """Коды позиций после каждого из ходов moves (как их делает push:
+    пешка на последнем ряду превращается в ферзя)"""
+    parent = encode_board(game)
+    moves = np.asarray(moves, dtype=np.int64).reshape(-1, 4)
+    src = moves[:, 0] * 8 + moves[:, 1]
+    dst = moves[:, 2] * 8 + moves[:, 3]
+
+    moving = parent[src].copy()
+    # Код пешки цвета color равен 1 + color * 6
+    for color in (WHITE, BLACK):
+        promoted = (moving == 1 + color * 6) & (moves[:, 2] == PAWN_END_ROWS[color])
+        moving[promoted] = 1 + color * 6 + QUEEN
+
+    rows = np.arange(len(moves))
+    codes = np.repeat(parent[None, :], len(moves), axis=0)
+    codes[rows, src] = 0
+    codes[rows, dst] = moving
+    return codes
+
+
+def evaluate_children(game, moves=None):
+    """Оценки (в единицах 1 / EVAL_SCALE) всех позиций после ходов moves
+    одним вызовом; по умолчанию --- после всех ходов из legal_moves"""
+    if moves is None:
+        moves = game.legal_moves()
+    if not moves:
+        return np.zeros(0, dtype=np.int64)
+    return evaluate_codes(encode_children(game, moves))
@@ -0,0 +1,242 @@
+import argparse
+import random
+import time
+
+import ai
+import chess
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def random_games(count, seed=0, max_plies=60):
+    """count случайных позиций из случайных партий от начальной расстановки"""
+    rng = random.Random(seed)
+    board = chess.ChessBoard(None, None)
+    games = []
+    while len(games) < count:
+        board.reset()
+        for _ in range(rng.randrange(max_plies)):
+            moves = board.legal_moves()
+            if not moves:
+                break
+            board.push(*rng.choice(moves))
+        board.search_ply = 0
+        games.append(board.clone())
+    return games
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+@benchmark
+def evaluation(count):
+    """Оценка count позиций: ai.evaluate_board по одной и batch_eval разом"""
+    import batch_eval
+
+    games = random_games(count)
+
+    scalar, scalar_time = timed(lambda: [ai.evaluate_board(game.board) for game in games])
+    codes, encode_time = timed(batch_eval.encode_boards, games)
+    batch, batch_time = timed(batch_eval.evaluate_codes, codes)
+
+    assert list(batch / ai.EVAL_SCALE) == scalar
+    print(f'evaluate_board: {count} positions, {scalar_time:.4f} s')
+    print(f'batch_eval:     {count} positions, {batch_time:.4f} s (+{encode_time:.4f} s encoding)')
+
+    children = 0
+    scalar_time = batch_time = 0
+    for game in games:
+        ai.init_evaluation(game)
+        moves = game.legal_moves()
+        children += len(moves)
+
+        start = time.perf_counter()
+        for move in moves:
+            game.push(*move)
+            ai.evaluate(game)
+            game.pop()
+        scalar_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch_eval.evaluate_children(game, moves)
+        batch_time += time.perf_counter() - start
+
+    print(f'children, push/pop:         {children} positions, {scalar_time:.4f} s')
+    print(f'children, evaluate_children: {children} positions, {batch_time:.4f} s')
+
+
+@benchmark
+def ordering(count, depth=4):
+    """Число узлов поиска на глубину depth без упорядочивания ходов и с ним"""
+    games = random_games(count, seed=1)
+    for name, make_ordering in (('board order', lambda: None), ('ordered', ai.MoveOrdering)):
+        nodes = 0
+        start = time.perf_counter()
+        for game in games:
+            control = ai.SearchControl()
+            ai.minimax_root(depth, game, game.color == chess.WHITE, ai.TranspositionTable(1), control,
+                            ordering=make_ordering())
+            nodes += control.nodes
+        elapsed = time.perf_counter() - start
+        print(f'{name}: {count} positions, depth {depth}: {nodes} nodes, {elapsed:.2f} s')
+
+
+@benchmark
+def quiescence(count, depth=2):
+    """Поиск на глубину depth без досчёта взятий на горизонте и с ним"""
+    games = random_games(count, seed=2)
+    for enabled in (False, True):
+        ai.QUIESCENCE = enabled
+        nodes = 0
+        start = time.perf_counter()
+        for game in games:
+            control = ai.SearchControl()
+            ai.minimax_root(depth, game, game.color == chess.WHITE, ai.TranspositionTable(1), control,
+                            ordering=ai.MoveOrdering())
+            nodes += control.nodes
+        elapsed = time.perf_counter() - start
+        print(f'quiescence {"on" if enabled else "off"}: {count} positions, depth {depth}: '
+              f'{nodes} nodes, {elapsed:.2f} s')
+
+
+@benchmark
+def search(count, depth=3):
+    """Итеративное углубление до глубины depth: minimax_root и negamax"""
+    games = random_games(count, seed=3)
+    for method in ai.SEARCH_METHODS:
+        nodes = 0
+        start = time.perf_counter()
+        for game in games:
+            _, _, searched, _ = ai.iterative_deepening(game, game.color == chess.WHITE, None, depth,
+                                                       ai.TranspositionTable(1), ai.MoveOrdering(), method)
+            nodes += searched
+        elapsed = time.perf_counter() - start
+        print(f'{method}: {count} positions, depth {depth}: {nodes} nodes, {elapsed:.2f} s')
+
+
+# Позиции с матом в один ход и матующий ход
+MATE_POSITIONS = [
+    ('data/saves/examples/mate_in_one.txt', (4, 5, 4, 0)),
+]
+
+
+@benchmark
+def mate(count, depth=4):
+    """Каждый метод поиска на каждой глубине до depth находит мат в один ход
+    в позициях MATE_POSITIONS. count ограничивает число позиций"""
+    for filename, expected in MATE_POSITIONS[:count]:
+        for method in ai.SEARCH_METHODS:
+            for max_depth in range(1, depth + 1):
+                game = chess.ChessBoard(None, None)
+                game.read_from_file(filename)
+                move, _, _, _ = ai.iterative_deepening(game, game.color == chess.WHITE, None, max_depth,
+                                                       ai.TranspositionTable(1), ai.MoveOrdering(), method)
+                assert move == expected, f'{filename}: {method}, depth {max_depth}: {move} instead of {expected}'
+        print(f'{filename}: mate found by {", ".join(ai.SEARCH_METHODS)} at depths 1-{depth}')
+
+
+PRUNING_POSITIONS = ['data/saves/perft/start.txt', 'data/saves/perft/middlegame.txt',
+                     'data/saves/perft/pins.txt', 'data/saves/perft/promotion.txt']
+
+
+@benchmark
+def pruning(count, depth=5):
+    """negamax до глубины depth на фиксированных позициях с разными
+    сочетаниями отсечения нулевым ходом и сокращения поздних ходов.
+    count ограничивает число позиций"""
+    games = []
+    for filename in PRUNING_POSITIONS[:count]:
+        game = chess.ChessBoard(None, None)
+        game.read_from_file(filename)
+        games.append(game)
+
+    for null_move, lmr in ((False, False), (True, False), (False, True), (True, True)):
+        ai.NULL_MOVE, ai.LMR = null_move, lmr
+        nodes = 0
+        start = time.perf_counter()
+        for game in games:
+            _, _, searched, _ = ai.iterative_deepening(game, game.color == chess.WHITE, None, depth,
+                                                       ai.TranspositionTable(1), ai.MoveOrdering(), ai.NEGAMAX)
+            nodes += searched
+        elapsed = time.perf_counter() - start
+        print(f'null move {"on " if null_move else "off"}, LMR {"on " if lmr else "off"}: '
+              f'{len(games)} positions, depth {depth}: {nodes} nodes, {elapsed:.2f} s')
+
+
+@benchmark
+def parallel(count, depth=3):
+    """minimax_root и parallel.ParallelSearch с разным числом процессов:
+    время, ускорение и совпадение выбранных ходов"""
+    import os
+    import parallel
+
+    games = random_games(count, seed=4)
+    games = [game for game in games if game.legal_moves()]
+
+    def serial_root(game):
+        return ai.minimax_root(depth, game, game.color == chess.WHITE,
+                               ai.TranspositionTable(parallel.WORKER_TT_SIZE_MB), ai.SearchControl(),
+                               ordering=ai.MoveOrdering())
+
+    serial, serial_time = timed(lambda: [serial_root(game) for game in games])
+    print(f'serial: {len(games)} positions, depth {depth}: {serial_time:.2f} s')
+
+    counts = sorted({1, 2, 4, os.cpu_count() or 1})
+    for workers in counts:
+        with parallel.ParallelSearch(workers) as search:
+            # Запуск процессов не входит в замер
+            search.root(1, games[0], games[0].color == chess.WHITE)
+            moves, elapsed = timed(lambda: [search.root(depth, game, game.color == chess.WHITE)
+                                            for game in games])
+        same = sum(a == b for a, b in zip(moves, serial))
+        print(f'{workers} workers: {elapsed:.2f} s, speedup {serial_time / elapsed:.2f}, '
+              f'same move in {same}/{len(games)}')
+
+
+@benchmark
+def smp(count, depth=5):
+    """Время до глубины depth для Lazy SMP с разным числом процессов"""
+    import os
+    import parallel
+
+    games = []
+    for filename in PRUNING_POSITIONS[:count]:
+        game = chess.ChessBoard(None, None)
+        game.read_from_file(filename)
+        games.append(game)
+
+    base_time = None
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        with parallel.LazySMPSearch(workers) as search:
+            search.search(games[0], None, 1)
+            elapsed = nodes = 0
+            for game in games:
+                search.tt.clear()
+                _, _, searched, _ = search.search(game, None, depth)
+                elapsed += search.elapsed
+                nodes += searched
+        if base_time is None:
+            base_time = elapsed
+        print(f'{workers} workers: {len(games)} positions to depth {depth}: {elapsed:.2f} s, '
+              f'{nodes} nodes, speedup {base_time / elapsed:.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Замеры скорости движка')
+    parser.add_argument('name', choices=sorted(BENCHMARKS))
+    parser.add_argument('-n', '--count', type=int, default=1000)
+    args = parser.parse_args()
+
+    BENCHMARKS[args.name](args.count)
+
+
+if __name__ == '__main__':
+    main()
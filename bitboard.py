@@ -0,0 +1,161 @@
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+
+# Клетка (row, col) доски кодируется номером row * 8 + col,
+# а множество клеток --- 64-битным числом (битбордом).
+SQUARES = [(sq // 8, sq % 8) for sq in range(64)]
+FULL = (1 << 64) - 1
+
+
+def square(row, col):
+    return row * 8 + col
+
+
+def lsb(bb):
+    """Номер младшего установленного бита"""
+    return (bb & -bb).bit_length() - 1
+
+
+def msb(bb):
+    """Номер старшего установленного бита"""
+    return bb.bit_length() - 1
+
+
+def to_squares(bb):
+    """Клетки (row, col) битборда в порядке обхода доски"""
+    out = []
+    while bb:
+        low = bb & -bb
+        out.append(SQUARES[low.bit_length() - 1])
+        bb ^= low
+    return out
+
+
+def _step_table(offsets):
+    table = []
+    for row, col in SQUARES:
+        bb = 0
+        for dr, dc in offsets:
+            r, c = row + dr, col + dc
+            if 0 <= r < 8 and 0 <= c < 8:
+                bb |= 1 << square(r, c)
+        table.append(bb)
+    return table
+
+
+def _ray_table(dr, dc):
+    table = []
+    for row, col in SQUARES:
+        bb = 0
+        r, c = row + dr, col + dc
+        while 0 <= r < 8 and 0 <= c < 8:
+            bb |= 1 << square(r, c)
+            r, c = r + dr, c + dc
+        table.append(bb)
+    return table
+
+
+KNIGHT_ATTACKS = _step_table(((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)))
+# Король ходит только по вертикали и горизонтали (см. chess.King.can_move)
+KING_ATTACKS = _step_table(((1, 0), (-1, 0), (0, 1), (0, -1)))
+# Клетки, которые бьёт пешка данного цвета: белые идут вверх по номерам рядов
+PAWN_ATTACKS = [_step_table(((1, 1), (1, -1))), _step_table(((-1, 1), (-1, -1)))]
+
+# Лучи: (таблица, идёт ли луч в сторону увеличения номеров клеток)
+ROOK_RAYS = [(_ray_table(1, 0), True), (_ray_table(0, 1), True),
+             (_ray_table(-1, 0), False), (_ray_table(0, -1), False)]
+BISHOP_RAYS = [(_ray_table(1, 1), True), (_ray_table(1, -1), True),
+               (_ray_table(-1, -1), False), (_ray_table(-1, 1), False)]
+
+
+def slider_attacks(sq, occupied, rays):
+    attacks = 0
+    for table, positive in rays:
+        ray = table[sq]
+        blockers = ray & occupied
+        if blockers:
+            if positive:
+                first = (blockers & -blockers).bit_length() - 1
+            else:
+                first = blockers.bit_length() - 1
+            ray ^= table[first]
+        attacks |= ray
+    return attacks
+
+
+def rook_attacks(sq, occupied):
+    return slider_attacks(sq, occupied, ROOK_RAYS)
+
+
+def bishop_attacks(sq, occupied):
+    return slider_attacks(sq, occupied, BISHOP_RAYS)
+
+
+def _between_table():
+    table = [[0] * 64 for _ in range(64)]
+    for sq in range(64):
+        for rays in (ROOK_RAYS, BISHOP_RAYS):
+            for ray_table, _ in rays:
+                ray = ray_table[sq]
+                bb = ray
+                while bb:
+                    low = bb & -bb
+                    target = low.bit_length() - 1
+                    # Клетки луча до target, не включая её
+                    table[sq][target] = ray & ~ray_table[target] & ~low
+                    bb ^= low
+    return table
+
+
+# BETWEEN[a][b] --- клетки строго между a и b, если они на одной линии
+BETWEEN = _between_table()
+ROOK_LINES = [rook_attacks(sq, 0) for sq in range(64)]
+BISHOP_LINES = [bishop_attacks(sq, 0) for sq in range(64)]
+
+
+class BitboardPosition:
+    def __init__(self):
+        self.pieces = [[0] * 6, [0] * 6]
+        self.occupied = [0, 0]
+
+    def clear(self):
+        self.pieces = [[0] * 6, [0] * 6]
+        self.occupied = [0, 0]
+
+    def put(self, sq, color, kind):
+        bit = 1 << sq
+        self.pieces[color][kind] |= bit
+        self.occupied[color] |= bit
+
+    def remove(self, sq, color, kind):
+        mask = ~(1 << sq)
+        self.pieces[color][kind] &= mask
+        self.occupied[color] &= mask
+
+    def get_occupied(self):
+        return self.occupied[WHITE] | self.occupied[BLACK]
+
+    def attackers_to(self, sq, by_color, occupied=None, by_pawns=True):
+        """Битборд фигур цвета by_color, атакующих клетку sq при
+        занятости доски occupied"""
+        if occupied is None:
+            occupied = self.occupied[WHITE] | self.occupied[BLACK]
+
+        pieces = self.pieces[by_color]
+        attackers = (KNIGHT_ATTACKS[sq] & pieces[KNIGHT]) | (KING_ATTACKS[sq] & pieces[KING])
+
+        if by_pawns:
+            attackers |= PAWN_ATTACKS[1 - by_color][sq] & pieces[PAWN]
+
+        rooks = pieces[ROOK] | pieces[QUEEN]
+        if rooks & ROOK_LINES[sq]:
+            attackers |= rook_attacks(sq, occupied) & rooks
+
+        bishops = pieces[BISHOP] | pieces[QUEEN]
+        if bishops & BISHOP_LINES[sq]:
+            attackers |= bishop_attacks(sq, occupied) & bishops
+
+        return attackers
+
+    def is_attacked(self, sq, by_color, occupied=None, by_pawns=True):
+        return self.attackers_to(sq, by_color, occupied, by_pawns) != 0
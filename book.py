@@ -0,0 +1,154 @@
+import argparse
+import mmap
+import os
+import random
+import struct
+import sys
+
+import chess
+from tt import encode_move, decode_move
+
+# Запись книги: ключ Зобриста позиции (ChessBoard.zobrist_key), ход
+# (tt.encode_move) и вес. Записи отсортированы по ключу, поэтому все ходы
+# позиции лежат подряд и находятся двоичным поиском прямо в отображённом
+# в память файле, без загрузки книги в объекты Python
+RECORD = struct.Struct('<QHH')
+RECORD_SIZE = RECORD.size
+KEY = struct.Struct('<Q')
+MAX_WEIGHT = 0xFFFF
+
+BOOK_PATH = 'data/book.bin'
+GAMES_PATH = 'data/openings.txt'
+# Сколько первых полуходов каждой партии попадает в книгу
+BOOK_PLIES = 16
+
+
+def parse_move(text):
+    """Ход в записи вида '2e-4e' (как perft.move_str)"""
+    src, dst = text.split('-')
+    return chess.from_chess_notation(src) + chess.from_chess_notation(dst)
+
+
+def read_games(filename):
+    """Партии из текстового файла: одна партия в строке, ходы через пробел
+    от начальной расстановки. Пустые строки и строки с # пропускаются.
+    Файл читается по строке, поэтому может быть сколь угодно большим"""
+    with open(filename, 'r') as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.split('#')[0].strip()
+            if line:
+                yield line_number, [parse_move(text) for text in line.split()]
+
+
+def build_book(game_files, book_file=BOOK_PATH, max_plies=BOOK_PLIES):
+    """Собрать книгу из первых max_plies полуходов партий game_files.
+    Вес хода --- число партий, в которых он сделан в этой позиции.
+    Возвращает число записей"""
+    weights = {}
+    board = chess.ChessBoard(None, None)
+
+    for filename in game_files:
+        for line_number, moves in read_games(filename):
+            for move in moves[:max_plies]:
+                if move not in board.legal_moves():
+                    print(f'{filename}:{line_number}: недопустимый ход {move}, партия обрезана', file=sys.stderr)
+                    break
+                entry = board.zobrist_key(), encode_move(move)
+                weights[entry] = weights.get(entry, 0) + 1
+                board.push(*move)
+
+            while board.search_ply:
+                board.pop()
+
+    with open(book_file, 'wb') as file:
+        for key, move in sorted(weights):
+            file.write(RECORD.pack(key, move, min(weights[key, move], MAX_WEIGHT)))
+
+    return len(weights)
+
+
+class OpeningBook:
+    """Дебютная книга, отображённая в память (см. RECORD)"""
+
+    def __init__(self, filename=BOOK_PATH):
+        self.file = open(filename, 'rb')
+        if os.fstat(self.file.fileno()).st_size:
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Пустой файл отобразить нельзя
+            self.data = b''
+        self.size = len(self.data) // RECORD_SIZE
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.size
+
+    def lower_bound(self, key):
+        """Номер первой записи с ключом не меньше key"""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if KEY.unpack_from(self.data, mid * RECORD_SIZE)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def probe(self, key):
+        """Ходы позиции с ключом key: список (ход, вес)"""
+        out = []
+        for index in range(self.lower_bound(key), self.size):
+            stored, move, weight = RECORD.unpack_from(self.data, index * RECORD_SIZE)
+            if stored != key:
+                break
+            out.append((decode_move(move), weight))
+        return out
+
+    def choose(self, game, rng=random):
+        """Случайный (с учётом весов) ход из книги для позиции game или None.
+        Ход проверяется по legal_moves на случай совпадения ключей"""
+        entries = self.probe(game.zobrist_key())
+        if not entries:
+            return None
+
+        legal = game.legal_moves()
+        entries = [(move, weight) for move, weight in entries if move in legal]
+        if not entries:
+            return None
+
+        moves, weights = zip(*entries)
+        return rng.choices(moves, weights)[0]
+
+
+def open_book(filename=BOOK_PATH):
+    """OpeningBook или None, если файла книги нет"""
+    if not os.path.exists(filename):
+        return None
+    return OpeningBook(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Сборка дебютной книги из файлов с партиями')
+    parser.add_argument('games', nargs='*', default=[GAMES_PATH],
+                        help='файлы с партиями: одна партия в строке, ходы вида 2e-4e')
+    parser.add_argument('-o', '--output', default=BOOK_PATH)
+    parser.add_argument('-p', '--plies', type=int, default=BOOK_PLIES,
+                        help='сколько первых полуходов партии попадает в книгу')
+    args = parser.parse_args()
+
+    count = build_book(args.games, args.output, args.plies)
+    print(f'{args.output}: {count} записей, {count * RECORD_SIZE} байт')
+
+
+if __name__ == '__main__':
+    main()
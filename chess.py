@@ -1,20 +1,24 @@
-from copy import deepcopy
-
 import pygame
 
+from bitboard import (BitboardPosition, SQUARES, FULL, to_squares, rook_attacks, bishop_attacks, BETWEEN,
+                      KNIGHT_ATTACKS, KING_ATTACKS, PAWN_ATTACKS, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING)
 from board import Board, LMB, RMB
+from zobrist import PIECE_KEYS, UNMOVED_KEYS, SIDE_KEY
 
 WHITE, BLACK = 0, 1
 WHITE_CELL_COLOR, BLACK_CELL_COLOR = pygame.Color('#FAE0C7'), pygame.Color('#BF7E44')
 PIECES_PATH = 'data/images/pieces/'
 CHESS_HORIZONTAL_LETTERS = 'ABCDEFGH'
+SEARCH_STACK_SIZE = 128
 
 
 class HistoryObject:
-    def __init__(self, old, new, color):
+    def __init__(self, old, new, color, unmoved=None):
         self.old = old
         self.new = new
         self.color = color
+        # Клетки, в которых до хода стояли ещё не ходившие ладьи и короли
+        self.unmoved = unmoved if unmoved is not None else []
 
 
 def correct_coords(row, col):
@@ -42,6 +46,17 @@ def to_chess_notation(pos, is_flipped=False):
     return get_row_letter(row, is_flipped) + get_col_letter(col, is_flipped)
 
 
+def from_chess_notation(text, is_flipped=False):
+    """Клетка (row, col) по записи вида '2e', обратная to_chess_notation"""
+    row = int(text[0]) - 1 if is_flipped else 8 - int(text[0])
+    col = CHESS_HORIZONTAL_LETTERS.index(text[1].upper())
+    if is_flipped:
+        col = 7 - col
+    if not correct_coords(row, col):
+        raise ValueError(f'Неверная клетка: {text}')
+    return row, col
+
+
 def opponent(color):
     """Удобная функция для вычисления цвета противника"""
     if color == WHITE:
@@ -115,25 +130,60 @@ def draw_chess(rect, pos, sender):
     if selected:
         selected_figure = sender.get_value(selected[0])
         if selected_figure is not None:
-            fpos = frow, fcell = selected_figure.get_pos(sender)
-            if not sender.move_will_cause_check(frow, fcell, r, c):
-                if selected_figure.can_move(sender, r, c):
-                    pygame.draw.circle(out_surface, pygame.Color('#1a508b'), (w // 2, h // 2), min(w, h) // 8)
-                    pygame.draw.circle(out_surface, pygame.Color('#1a508b'), (w // 2, h // 2), min(w, h) // 4, 6)
-                elif isinstance(selected_figure, (King, Rook)):
-                    if selected_figure.can_castle(sender, r, c):
-                        pygame.draw.circle(out_surface, pygame.Color('#1a508b'), (w // 2, h // 2), min(w, h) // 8)
-                        pygame.draw.circle(out_surface, pygame.Color('#1a508b'), (w // 2, h // 2), min(w, h) // 4, 6)
-                if selected_figure.can_attack(sender, r, c):
+            fcell, frow = selected[0]
+            if selected_figure.get_color() == sender.color:
+                targets = sender.get_legal_targets(frow, fcell)
+            else:
+                targets = selected_figure.get_targets(sender, frow, fcell)
+
+            if (r, c) in targets:
+                pygame.draw.circle(out_surface, pygame.Color('#1a508b'), (w // 2, h // 2), min(w, h) // 8)
+                pygame.draw.circle(out_surface, pygame.Color('#1a508b'), (w // 2, h // 2), min(w, h) // 4, 6)
+                if cell is not None:
                     pygame.draw.circle(out_surface, pygame.Color('red'), (w // 2, h // 2), min(w, h) // 8)
                     pygame.draw.circle(out_surface, pygame.Color('red'), (w // 2, h // 2), min(w, h) // 4, 6)
+            elif isinstance(selected_figure, (King, Rook)):
+                if selected_figure.can_castle(sender, frow, fcell, r, c):
+                    pygame.draw.circle(out_surface, pygame.Color('#1a508b'), (w // 2, h // 2), min(w, h) // 8)
+                    pygame.draw.circle(out_surface, pygame.Color('#1a508b'), (w // 2, h // 2), min(w, h) // 4, 6)
 
     return out_surface
 
 
+# Направление хода пешек, начальный ряд (откуда возможен ход на 2 клетки)
+# и ряд превращения для белых и чёрных
+PAWN_DIRECTIONS = (1, -1)
+PAWN_START_ROWS = (1, 6)
+PAWN_END_ROWS = (7, 0)
+
+# Фигуры неизменяемы: для каждого сочетания (класс, цвет) существует
+# единственный экземпляр, который ставится во все клетки доски
+FIGURES = {}
+
+
 class Figure:
-    def __init__(self, color):
-        self.color = color
+    __slots__ = ('color',)
+    kind = None
+
+    def __new__(cls, color):
+        piece = FIGURES.get((cls, color))
+        if piece is None:
+            piece = object.__new__(cls)
+            object.__setattr__(piece, 'color', color)
+            FIGURES[cls, color] = piece
+        return piece
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Фигуры неизменяемы')
+
+    def __reduce__(self):
+        return self.__class__, (self.color,)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def color_str(self):
         color = 'WHITE' if self.get_color() == WHITE else 'BLACK'
@@ -142,65 +192,58 @@ class Figure:
     def get_color(self):
         return self.color
 
-    def get_pos(self, board):
-        for r in range(8):
-            for c in range(8):
-                if board.get_value((c, r)) is self:
-                    return r, c
-
-    def can_move(self, board, row1, col1):
+    def can_move(self, board, row, col, row1, col1):
         return False
 
-    def can_attack(self, board, row1, col1):
+    def can_attack(self, board, row, col, row1, col1):
         fig = board.get_value((col1, row1))
         is_opponent = fig is not None and fig.get_color() == opponent(self.get_color())
-        return self.can_move(board, row1, col1) and is_opponent
+        return self.can_move(board, row, col, row1, col1) and is_opponent
 
+    def get_target_mask(self, position, sq):
+        """Битборд клеток, куда фигура из клетки sq может пойти или
+        которые может взять, без учёта шаха своему королю"""
+        return 0
 
-class Castleable(Figure):
-    def __init__(self, color):
-        super().__init__(color)
-        self.has_moved = False
+    def get_targets(self, board, row, col):
+        return to_squares(self.get_target_mask(board.bitboards, row * 8 + col))
 
-    def check_if_moved(self):
-        return self.has_moved
 
-    def set_has_moved(self):
-        self.has_moved = True
+class Castleable(Figure):
+    # Ходила ли фигура, хранит доска (см. ChessBoard.has_moved)
+    __slots__ = ()
 
-    def can_castle(self, board, row1, col1):
+    def can_castle(self, board, row, col, row1, col1):
         if board.is_check():
             return False
 
-        if not self.check_if_moved():
+        if not board.has_moved(row, col):
             new_fig = board.get_piece(row1, col1)
             if isinstance(new_fig, (Rook, King)) and not isinstance(new_fig, self.__class__):
-                if new_fig.get_color() == self.get_color() and not new_fig.check_if_moved():
+                if new_fig.get_color() == self.get_color() and not board.has_moved(row1, col1):
                     return True
 
         return False
 
 
 class Rook(Castleable):
-    def __init__(self, color):
-        super().__init__(color)
+    __slots__ = ()
+    kind = ROOK
 
     def __str__(self):
         color = self.color_str()
         return f'Rook({color})'
 
-    def char(self):
+    def char(self, has_moved=False):
         out = 'R'
         out += 'W' if self.get_color() == WHITE else 'B'
-        out += 'M' if self.check_if_moved() else 'N'
+        out += 'M' if has_moved else 'N'
         return out
 
     def raw_char(self):
         return self.char()[0]
 
-    def can_move(self, board, row1, col1):
-        row, col = self.get_pos(board)
-
+    def can_move(self, board, row, col, row1, col1):
         # Невозможно сделать ход в клетку, которая не лежит в том же ряду
         # или столбце клеток.
         if row != row1 and col != col1:
@@ -222,15 +265,13 @@ class Rook(Castleable):
 
         return is_free_cell((col1, row1), board, self.get_color())
 
+    def get_target_mask(self, position, sq):
+        return rook_attacks(sq, position.get_occupied()) & ~position.occupied[self.color]
+
 
 class Pawn(Figure):
-    def __init__(self, color):
-        super().__init__(color)
-        self.direction = 1 if color == WHITE else -1
-        self.start_row = 1 if color == WHITE else 6
-        self.end_row = 7 if color == WHITE else 0
-        # Пешка может сделать из начального положения ход на 2 клетки
-        # вперёд, поэтому поместим индекс начального ряда в start_row.
+    __slots__ = ()
+    kind = PAWN
 
     def __str__(self):
         color = self.color_str()
@@ -244,33 +285,31 @@ class Pawn(Figure):
     def raw_char(self):
         return self.char()[0]
 
-    def can_move(self, board, row1, col1):
-        row, col = self.get_pos(board)
+    def can_move(self, board, row, col, row1, col1):
         # Пешка может ходить только по вертикали
         # "взятие на проходе" не реализовано
         if col != col1:
             return False
 
+        direction = PAWN_DIRECTIONS[self.color]
+
         # ход на 1 клетку
-        if row + self.direction == row1 and col == col1:
+        if row + direction == row1 and col == col1:
             return board.get_piece(row1, col1) is None
 
         # ход на 2 клетки из начального положения
-        if (row == self.start_row
-                and row + 2 * self.direction == row1
-                and board.get_piece(row + 2 * self.direction, col) is None and col == col1):
+        if (row == PAWN_START_ROWS[self.color]
+                and row + 2 * direction == row1
+                and board.get_piece(row + 2 * direction, col) is None and col == col1):
             return True
 
         return False
 
-    def can_promote(self, board):
-        row, _ = self.get_pos(board)
-        return row == self.end_row
-
-    def can_attack(self, board, row1, col1):
-        row, col = self.get_pos(board)
+    def can_promote(self, row):
+        return row == PAWN_END_ROWS[self.color]
 
-        direction = 1 if (self.color == WHITE) else -1
+    def can_attack(self, board, row, col, row1, col1):
+        direction = PAWN_DIRECTIONS[self.color]
         if row + direction == row1 and (col + 1 == col1 or col - 1 == col1):
             piece = board.get_piece(row1, col1)
             if isinstance(piece, (Pawn, Knight, Bishop, Rook, Queen)):
@@ -278,11 +317,32 @@ class Pawn(Figure):
                 return self.color != cl
         return False
 
+    def get_target_mask(self, position, sq):
+        row = sq // 8
+        direction = PAWN_DIRECTIONS[self.color]
+        if not 0 <= row + direction < 8:
+            return 0
+
+        occupied = position.get_occupied()
+        step = 8 * direction
+        mask = 0
+
+        if not occupied >> (sq + step) & 1:
+            mask |= 1 << (sq + step)
+        # Как и в can_move, проверяется только конечная клетка
+        if row == PAWN_START_ROWS[self.color] and not occupied >> (sq + 2 * step) & 1:
+            mask |= 1 << (sq + 2 * step)
+
+        # Пешка не может взять короля (см. can_attack)
+        enemy = opponent(self.color)
+        victims = position.occupied[enemy] & ~position.pieces[enemy][KING]
+
+        return mask | (PAWN_ATTACKS[self.color][sq] & victims)
+
 
 class Knight(Figure):
-    def __init__(self, color):
-        super().__init__(color)
-        self.color = color
+    __slots__ = ()
+    kind = KNIGHT
 
     def __str__(self):
         color = self.color_str()
@@ -296,9 +356,7 @@ class Knight(Figure):
     def raw_char(self):
         return self.char()[0]
 
-    def can_move(self, board, row1, col1):
-        row, col = self.get_pos(board)
-
+    def can_move(self, board, row, col, row1, col1):
         if (not correct_coords(row, col)) or (row1 == row or col1 == col):
             return False
         else:
@@ -306,28 +364,28 @@ class Knight(Figure):
             is_free = is_free_cell((col1, row1), board, self.get_color())
             return coords_ok and is_free
 
+    def get_target_mask(self, position, sq):
+        return KNIGHT_ATTACKS[sq] & ~position.occupied[self.color]
+
 
 class King(Castleable):
-    def __init__(self, color):
-        super().__init__(color)
-        self.has_moved = False
+    __slots__ = ()
+    kind = KING
 
     def __str__(self):
         color = self.color_str()
         return f'King({color})'
 
-    def char(self):
+    def char(self, has_moved=False):
         out = 'K'
         out += 'W' if self.get_color() == WHITE else 'B'
-        out += 'M' if self.check_if_moved() else 'N'
+        out += 'M' if has_moved else 'N'
         return out
 
     def raw_char(self):
         return self.char()[0]
 
-    def can_move(self, board, row1, col1):
-        row, col = self.get_pos(board)
-
+    def can_move(self, board, row, col, row1, col1):
         neighbours = board.get_neighbours((col, row))
         check_list = []
         for n in neighbours:
@@ -338,10 +396,13 @@ class King(Castleable):
 
         return (col1, row1) in check_list
 
+    def get_target_mask(self, position, sq):
+        return KING_ATTACKS[sq] & ~position.occupied[self.color]
+
 
 class Queen(Figure):
-    def __init__(self, color):
-        super().__init__(color)
+    __slots__ = ()
+    kind = QUEEN
 
     def __str__(self):
         color = self.color_str()
@@ -355,9 +416,7 @@ class Queen(Figure):
     def raw_char(self):
         return self.char()[0]
 
-    def can_move(self, board, row1, col1):
-        row, col = self.get_pos(board)
-
+    def can_move(self, board, row, col, row1, col1):
         is_diag = abs(col1 - col) == abs(row1 - row)
 
         if (row1 != row) and (col1 != col) and is_diag:
@@ -387,10 +446,15 @@ class Queen(Figure):
 
         return is_free_cell((col1, row1), board, self.get_color())
 
+    def get_target_mask(self, position, sq):
+        occupied = position.get_occupied()
+        attacks = rook_attacks(sq, occupied) | bishop_attacks(sq, occupied)
+        return attacks & ~position.occupied[self.color]
+
 
 class Bishop(Figure):
-    def __init__(self, color):
-        super().__init__(color)
+    __slots__ = ()
+    kind = BISHOP
 
     def __str__(self):
         color = self.color_str()
@@ -404,9 +468,7 @@ class Bishop(Figure):
     def raw_char(self):
         return self.char()[0]
 
-    def can_move(self, board, row1, col1):
-        row, col = self.get_pos(board)
-
+    def can_move(self, board, row, col, row1, col1):
         is_diag = abs(col1 - col) == abs(row1 - row)
 
         if (row1 != row) and (col1 != col) and is_diag:
@@ -424,6 +486,9 @@ class Bishop(Figure):
 
         return is_free_cell((col1, row1), board, self.get_color())
 
+    def get_target_mask(self, position, sq):
+        return bishop_attacks(sq, position.get_occupied()) & ~position.occupied[self.color]
+
 
 PIECES_CHARS = {
     'Q': Queen,
@@ -439,6 +504,36 @@ COLOR_CHARS = {
     'B': BLACK
 }
 
+# Код фигуры в снимке позиции: 0 --- пустая клетка, иначе 1 + color * 6 + kind
+SNAPSHOT_PIECES = [None] + [cls(color) for color in (WHITE, BLACK)
+                            for cls in (Pawn, Knight, Bishop, Rook, Queen, King)]
+
+
+class Snapshot:
+    """Компактный снимок позиции: 64 байта с кодами фигур (клетка
+    row * 8 + col), очередь хода и битборд прав на рокировку.
+    Не ссылается на объекты pygame и фигуры, поэтому легко
+    передаётся в другие процессы и хранится в кэшах"""
+    __slots__ = ('squares', 'color', 'unmoved')
+
+    def __init__(self, squares, color, unmoved):
+        self.squares = squares
+        self.color = color
+        self.unmoved = unmoved
+
+    def __eq__(self, other):
+        return (isinstance(other, Snapshot) and self.squares == other.squares
+                and self.color == other.color and self.unmoved == other.unmoved)
+
+    def __hash__(self):
+        return hash((self.squares, self.color, self.unmoved))
+
+    def __getstate__(self):
+        return self.squares, self.color, self.unmoved
+
+    def __setstate__(self, state):
+        self.squares, self.color, self.unmoved = state
+
 
 def read_board_from_file(filename, pieces_chars=None, color_chars=None, empty_char='-'):
     if pieces_chars is None:
@@ -449,6 +544,7 @@ def read_board_from_file(filename, pieces_chars=None, color_chars=None, empty_ch
     file = open(filename, 'r')
     lines = file.readlines()
     out = []
+    moved = set()
 
     move_char = lines[0][0]
     if move_char == 'B':
@@ -476,7 +572,7 @@ def read_board_from_file(filename, pieces_chars=None, color_chars=None, empty_ch
 
                 if piece_class in (Rook, King):
                     if len(cell) > 2 and cell[2] == 'M':
-                        piece.set_has_moved()
+                        moved.add((len(out) - 1, len(out[-1])))
 
                 out[-1].append(piece)
 
@@ -488,19 +584,28 @@ def read_board_from_file(filename, pieces_chars=None, color_chars=None, empty_ch
     while len(out) < 8:
         out.append([None for _ in range(8)])
 
-    return out, curr_move
+    return out, curr_move, moved
 
 
-def write_board_to_file(filename, board, curr_move=WHITE, pieces_chars=None, color_chars=None, empty_char='-'):
+def write_board_to_file(filename, board, curr_move=WHITE, pieces_chars=None, color_chars=None, empty_char='-',
+                        moved=()):
+    """moved --- клетки (row, col) уже ходивших ладей и королей"""
     if pieces_chars is None:
         pieces_chars = PIECES_CHARS
     if color_chars is None:
         color_chars = COLOR_CHARS
 
     lines = ['B\n' if curr_move == BLACK else 'W\n']
-    for line in board:
-        line = [x.char() if isinstance(x, (Pawn, Bishop, Knight, Rook, Queen, King)) else empty_char for x in line]
-        lines.append(' '.join(line) + '\n')
+    for r, line in enumerate(board):
+        out = []
+        for c, x in enumerate(line):
+            if isinstance(x, (Rook, King)):
+                out.append(x.char((r, c) in moved))
+            elif isinstance(x, (Pawn, Bishop, Knight, Queen)):
+                out.append(x.char())
+            else:
+                out.append(empty_char)
+        lines.append(' '.join(out) + '\n')
 
     file = open(filename, 'w')
     file.writelines(lines)
@@ -535,23 +640,182 @@ class ChessBoard(Board):
         self.pieces_chars = PIECES_CHARS
         self.colors_chars = COLOR_CHARS
 
-        self.starting_board = deepcopy(self.board)
+        # Фигуры неизменяемы, поэтому достаточно скопировать ряды
+        self.starting_board = [row[:] for row in self.board]
         self.history = []
         self.history_pos = -1
 
+        # Стек ходов поиска (push/pop): для каждого хода
+        # [row, col, row1, col1, фигура, взятая фигура, превращение, цвет, unmoved, hash]
+        self.search_stack = [[None] * 10 for _ in range(SEARCH_STACK_SIZE)]
+        self.search_ply = 0
+
+        # Позиция в виде битбордов для генерации ходов и поиска шахов
+        self.bitboards = BitboardPosition()
+        # Битборд клеток с ещё не ходившими ладьями и королями (права на рокировку)
+        self.unmoved = 0
+        # Ключ Зобриста расстановки фигур и прав на рокировку (без очереди хода)
+        self.hash = 0
+        # Таблицы оценки eval_tables[color][kind][sq] (см. ai.EVAL_TABLES)
+        # и оценка позиции, которая пересчитывается при каждом изменении доски
+        self.eval_tables = None
+        self.evaluation = 0
+        self.update_positions()
+        self.reset_castling_rights()
+
+        # Ходы и наличие шаха для позиции с ключом status_key
+        self.status_key = None
+        self.status = None
+
     def reset(self):
-        self.board = self.starting_board
+        self.board = [row[:] for row in self.starting_board]
         self.color = WHITE
         self.history = []
         self.history_pos = -1
+        self.update_positions()
+        self.reset_castling_rights()
 
-    def set_board(self, board):
+    def set_board(self, board, moved=()):
+        """moved --- клетки (row, col) уже ходивших ладей и королей"""
         for r, current_row in enumerate(board):
             for c, fig in enumerate(current_row):
                 if isinstance(fig, (King, Queen, Knight, Rook, Pawn, Bishop)) or fig is None:
-                    self.board[r][c] = fig
+                    self.set_piece(r, c, fig)
+        self.reset_castling_rights(moved)
+        self.history = []
+        self.history_pos = -1
+
+    def update_positions(self):
+        """Полностью перестроить битборды, ключ Зобриста и оценку по доске"""
+        self.bitboards.clear()
+        for r, row in enumerate(self.board):
+            for c, fig in enumerate(row):
+                if fig is not None:
+                    self.bitboards.put(r * 8 + c, fig.get_color(), fig.kind)
+        self.hash = self.compute_hash()
+        self.evaluation = self.compute_evaluation()
+
+    def set_evaluation(self, tables):
+        """Поддерживать оценку позиции по таблицам tables[color][kind][sq]"""
+        self.eval_tables = tables
+        self.evaluation = self.compute_evaluation()
+
+    def compute_evaluation(self):
+        tables = self.eval_tables
+        if tables is None:
+            return 0
+
+        total = 0
+        for color in (WHITE, BLACK):
+            for kind, bb in enumerate(self.bitboards.pieces[color]):
+                table = tables[color][kind]
+                while bb:
+                    low = bb & -bb
+                    total += table[low.bit_length() - 1]
+                    bb ^= low
+        return total
+
+    def to_snapshot(self):
+        squares = bytearray(64)
+        for color in (WHITE, BLACK):
+            for kind, bb in enumerate(self.bitboards.pieces[color]):
+                code = 1 + color * 6 + kind
+                while bb:
+                    low = bb & -bb
+                    squares[low.bit_length() - 1] = code
+                    bb ^= low
+        return Snapshot(bytes(squares), self.color, self.unmoved)
+
+    def set_snapshot(self, snapshot):
+        """Поставить на доску позицию из снимка. История ходов очищается"""
+        squares = snapshot.squares
+        self.board = [[SNAPSHOT_PIECES[x] for x in squares[r * 8:r * 8 + 8]] for r in range(8)]
+        self.color = snapshot.color
+        self.unmoved = snapshot.unmoved
+        self.update_positions()
         self.history = []
         self.history_pos = -1
+        self.search_ply = 0
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Новая доска без параметров отрисовки с позицией из снимка"""
+        board = cls(None, None)
+        board.set_snapshot(snapshot)
+        return board
+
+    def clone(self):
+        """Копия позиции для поиска: без истории ходов, выделенных клеток
+        и функции выбора фигуры при превращении"""
+        board = self.from_snapshot(self.to_snapshot())
+        board.set_evaluation(self.eval_tables)
+        board.status_key, board.status = self.status_key, self.status
+        return board
+
+    def reset_castling_rights(self, moved=()):
+        """Считать все ладьи и короли, кроме стоящих в клетках moved, не ходившими"""
+        self.unmoved = 0
+        for color in (WHITE, BLACK):
+            self.unmoved |= self.bitboards.pieces[color][ROOK] | self.bitboards.pieces[color][KING]
+        for r, c in moved:
+            self.unmoved &= ~(1 << (r * 8 + c))
+        self.hash = self.compute_hash()
+
+    def compute_hash(self):
+        """Вычислить ключ Зобриста позиции заново, обходом всей доски"""
+        key = 0
+        for r, row in enumerate(self.board):
+            for c, fig in enumerate(row):
+                if fig is not None:
+                    key ^= PIECE_KEYS[fig.color][fig.kind][r * 8 + c]
+        for r, c in to_squares(self.unmoved):
+            key ^= UNMOVED_KEYS[r * 8 + c]
+        return key
+
+    def zobrist_key(self):
+        """Ключ Зобриста позиции с учётом очереди хода"""
+        if self.color == BLACK:
+            return self.hash ^ SIDE_KEY
+        return self.hash
+
+    def has_moved(self, row, col):
+        return not self.unmoved >> (row * 8 + col) & 1
+
+    def set_has_moved(self, row, col, value=True):
+        piece = self.board[row][col]
+        if isinstance(piece, Castleable) and self.has_moved(row, col) != value:
+            self.hash ^= UNMOVED_KEYS[row * 8 + col]
+            self.unmoved ^= 1 << (row * 8 + col)
+
+    def get_moved(self):
+        """Клетки уже ходивших ладей и королей"""
+        castleable = 0
+        for color in (WHITE, BLACK):
+            castleable |= self.bitboards.pieces[color][ROOK] | self.bitboards.pieces[color][KING]
+        return set(to_squares(castleable & ~self.unmoved))
+
+    def set_piece(self, row, col, piece):
+        """Поставить фигуру (или None) в клетку (row, col), поддерживая
+        битборды и ключ Зобриста. Новая фигура в клетке считается уже
+        ходившей (см. set_has_moved)"""
+        old = self.board[row][col]
+        sq = row * 8 + col
+        tables = self.eval_tables
+        if old is not None:
+            self.bitboards.remove(sq, old.color, old.kind)
+            self.hash ^= PIECE_KEYS[old.color][old.kind][sq]
+            if tables is not None:
+                self.evaluation -= tables[old.color][old.kind][sq]
+        if self.unmoved >> sq & 1:
+            self.unmoved ^= 1 << sq
+            self.hash ^= UNMOVED_KEYS[sq]
+
+        self.board[row][col] = piece
+        if piece is not None:
+            self.bitboards.put(sq, piece.color, piece.kind)
+            self.hash ^= PIECE_KEYS[piece.color][piece.kind][sq]
+            if tables is not None:
+                self.evaluation += tables[piece.color][piece.kind][sq]
 
     def get_board(self):
         return self.board
@@ -562,12 +826,14 @@ class ChessBoard(Board):
         self.color = color
 
     def read_from_file(self, filename, empty_char='-'):
-        new_board, curr_move = read_board_from_file(filename, self.pieces_chars, self.colors_chars, empty_char)
-        self.set_board(new_board)
+        new_board, curr_move, moved = read_board_from_file(filename, self.pieces_chars, self.colors_chars,
+                                                           empty_char)
+        self.set_board(new_board, moved)
         self.set_color(curr_move)
 
     def write_to_file(self, filename, empty_char='-'):
-        write_board_to_file(filename, self.board, self.color, self.pieces_chars, self.colors_chars, empty_char)
+        write_board_to_file(filename, self.board, self.color, self.pieces_chars, self.colors_chars, empty_char,
+                            self.get_moved())
 
     def current_player_color(self):
         return self.color
@@ -594,10 +860,10 @@ class ChessBoard(Board):
         if piece.get_color() != self.color:
             return False
         if self.board[row1][col1] is None:
-            if not piece.can_move(self, row1, col1):
+            if not piece.can_move(self, row, col, row1, col1):
                 return False
         elif self.board[row1][col1].get_color() == opponent(piece.get_color()):
-            if not piece.can_attack(self, row1, col1):
+            if not piece.can_attack(self, row, col, row1, col1):
                 return False
         else:
             return False
@@ -605,21 +871,18 @@ class ChessBoard(Board):
         return True
 
     def get_figures(self, color=None):
-        out = []
-
-        for row in self.board:
-            for fig in row:
-                if fig is not None:
-                    if color is None or fig.get_color() == color:
-                        out.append(fig)
+        if color is None:
+            squares = to_squares(self.bitboards.get_occupied())
+        else:
+            squares = self.get_figure_positions(color)
 
-        return out
+        return [self.board[r][c] for r, c in squares]
 
     def get_figure_positions(self, color=None):
         if color is None:
             color = self.color
 
-        return [x.get_pos(self) for x in self.get_figures(color)]
+        return to_squares(self.bitboards.occupied[color])
 
     def get_possible_moves(self, color=None):
         if color is None:
@@ -627,12 +890,20 @@ class ChessBoard(Board):
 
         out = []
 
-        positions = self.get_figure_positions(color)
-        for row, col in positions:
-            for r in range(8):
-                for c in range(8):
-                    if self.can_move_piece(row, col, r, c):
-                        out.append((row, col, r, c))
+        # Как и в can_move_piece, ходить может только текущий игрок
+        if color != self.color:
+            return out
+
+        position = self.bitboards
+        pieces = position.occupied[color]
+        while pieces:
+            low = pieces & -pieces
+            sq = low.bit_length() - 1
+            pieces ^= low
+
+            row, col = SQUARES[sq]
+            for r, c in to_squares(self.board[row][col].get_target_mask(position, sq)):
+                out.append((row, col, r, c))
 
         return out
 
@@ -640,38 +911,45 @@ class ChessBoard(Board):
         if color is None:
             color = self.color
 
-        kings = [x.get_pos(self) for x in self.get_figures(color) if isinstance(x, King)]
+        kings = self.bitboards.pieces[color][KING]
         if kings:
-            return kings[-1]
+            # Если королей несколько, берётся последний по обходу доски
+            return SQUARES[kings.bit_length() - 1]
         else:
             return None
 
+    def is_square_attacked(self, square, by_color):
+        """Проверить, может ли фигура цвета by_color взять фигуру в клетке
+        square = (row, col). Проверка идёт от самой клетки: лучи
+        дальнобойных фигур, ходы коня, соседние клетки и диагонали пешек"""
+        row, col = square
+        # Пешка не может взять короля (см. Pawn.can_attack)
+        piece = self.board[row][col]
+        by_pawns = piece is None or piece.kind != KING
+        return self.bitboards.is_attacked(row * 8 + col, by_color, by_pawns=by_pawns)
+
     def is_check(self):
-        if not self.get_king(self.color):
+        kings = self.bitboards.pieces[self.color][KING]
+        if not kings:
             # print('Warning: no king found!')
             return False
 
-        opponent_figures = self.get_figures(opponent(self.color))
-        king = self.get_king()
-
-        for fig in opponent_figures:
-            if fig.can_attack(self, *king):
-                return True
-
-        return False
+        return self.is_square_attacked(SQUARES[kings.bit_length() - 1], opponent(self.color))
 
     def move_will_cause_check(self, row, col, row1, col1):
         if not self.can_move_piece(row, col, row1, col1):
             return False
 
         piece1, piece2 = self.board[row][col], self.board[row1][col1]
-        self.board[row][col] = None
-        self.board[row1][col1] = piece1
+        unmoved, key = self.unmoved, self.hash
+        self.set_piece(row, col, None)
+        self.set_piece(row1, col1, piece1)
 
         ch = self.is_check()
 
-        self.board[row][col] = piece1
-        self.board[row1][col1] = piece2
+        self.set_piece(row, col, piece1)
+        self.set_piece(row1, col1, piece2)
+        self.unmoved, self.hash = unmoved, key
 
         return ch
 
@@ -681,8 +959,198 @@ class ChessBoard(Board):
 
         return [x for x in self.get_possible_moves(color) if not self.move_will_cause_check(*x)]
 
+    def get_pins_and_checks(self, color=None):
+        """Найти короля цвета color, связанные фигуры и шахующие фигуры.
+        Возвращает (king, pins, checkers, blocks), где king --- номер клетки
+        короля, pins --- словарь клетка связанной фигуры -> битборд клеток,
+        куда она может пойти вдоль связки, checkers --- битборд шахующих
+        фигур, blocks --- битборд клеток, ход в которые закрывает от шаха
+        или берёт единственную шахующую фигуру"""
+        if color is None:
+            color = self.color
+
+        position = self.bitboards
+        kings = position.pieces[color][KING]
+        if not kings:
+            return None, {}, 0, 0
+
+        king = kings.bit_length() - 1
+        enemy = opponent(color)
+        own = position.occupied[color]
+        occupied = position.get_occupied()
+        enemy_pieces = position.pieces[enemy]
+
+        checkers = position.attackers_to(king, enemy, occupied, by_pawns=False)
+        blocks = checkers
+        pins = {}
+
+        # Дальнобойные фигуры противника, которые били бы короля на пустой доске
+        snipers = ((rook_attacks(king, 0) & (enemy_pieces[ROOK] | enemy_pieces[QUEEN]))
+                   | (bishop_attacks(king, 0) & (enemy_pieces[BISHOP] | enemy_pieces[QUEEN])))
+        while snipers:
+            low = snipers & -snipers
+            sniper = low.bit_length() - 1
+            snipers ^= low
+
+            between = BETWEEN[king][sniper]
+            blockers = between & occupied
+            if not blockers:
+                blocks |= between
+            elif blockers & (blockers - 1) == 0 and blockers & own:
+                pins[blockers.bit_length() - 1] = between | low
+
+        return king, pins, checkers, blocks
+
+    def get_legal_mask(self, sq, pins_and_checks, targets=FULL):
+        """Битборд клеток из targets, куда фигура из клетки sq может пойти,
+        не оставляя своего короля под шахом"""
+        row, col = SQUARES[sq]
+        piece = self.board[row][col]
+        position = self.bitboards
+        mask = piece.get_target_mask(position, sq) & targets
+
+        king, pins, checkers, blocks = pins_and_checks
+        if king is None:
+            return mask
+
+        if sq == king:
+            enemy = opponent(self.color)
+            occupied = position.get_occupied() & ~(1 << king)
+            legal = 0
+            while mask:
+                low = mask & -mask
+                mask ^= low
+                if not position.attackers_to(low.bit_length() - 1, enemy, occupied, by_pawns=False):
+                    legal |= low
+            return legal
+
+        if checkers:
+            if checkers & (checkers - 1):
+                return 0
+            mask &= blocks
+        if sq in pins:
+            mask &= pins[sq]
+
+        return mask
+
+    def get_legal_targets(self, row, col):
+        """Клетки, куда фигура из (row, col) может пойти, не оставляя
+        своего короля под шахом"""
+        moves, _ = self.get_position_status()
+        return [(r1, c1) for r, c, r1, c1 in moves if r == row and c == col]
+
+    def generate_legal_moves(self):
+        """Ходы текущего игрока без пробных ходов: связки и шахи
+        вычисляются один раз для всей позиции"""
+        color = self.color
+        position = self.bitboards
+        kings = position.pieces[color][KING]
+        if kings & (kings - 1):
+            return self.moves_without_check(color)
+
+        out = []
+        pins_and_checks = self.get_pins_and_checks(color)
+
+        pieces = position.occupied[color]
+        while pieces:
+            low = pieces & -pieces
+            sq = low.bit_length() - 1
+            pieces ^= low
+
+            row, col = SQUARES[sq]
+            for r, c in to_squares(self.get_legal_mask(sq, pins_and_checks)):
+                out.append((row, col, r, c))
+
+        return out
+
+    def legal_captures(self):
+        """Взятия и превращения пешек текущего игрока, не оставляющие
+        короля под шахом. В отличие от legal_moves, тихие ходы даже не
+        генерируются, а результат не запоминается"""
+        color = self.color
+        enemy_color = opponent(color)
+        position = self.bitboards
+
+        kings = position.pieces[color][KING]
+        if kings & (kings - 1):
+            board = self.board
+            enemy = position.occupied[enemy_color]
+            return [(row, col, r, c) for row, col, r, c in self.moves_without_check(color)
+                    if enemy >> (r * 8 + c) & 1 or (board[row][col].kind == PAWN and r == PAWN_END_ROWS[color])]
+
+        king, pins, checkers, blocks = self.get_pins_and_checks(color)
+        occupied = position.get_occupied()
+        double_check = checkers & (checkers - 1)
+        enemy_king = position.pieces[enemy_color][KING]
+
+        def is_legal(sq, low):
+            if sq == king:
+                return not position.attackers_to(low.bit_length() - 1, enemy_color, occupied & ~(1 << king),
+                                                  by_pawns=False)
+            if king is None:
+                return True
+            if double_check or (checkers and not low & blocks):
+                return False
+            return sq not in pins or low & pins[sq]
+
+        out = []
+        # Для каждой фигуры противника --- все свои фигуры, которые её бьют
+        victims = position.occupied[enemy_color]
+        while victims:
+            low = victims & -victims
+            victims ^= low
+            target = low.bit_length() - 1
+            # Пешка не может взять короля (см. Pawn.can_attack)
+            attackers = position.attackers_to(target, color, occupied, by_pawns=not low & enemy_king)
+            while attackers:
+                attacker = attackers & -attackers
+                attackers ^= attacker
+                sq = attacker.bit_length() - 1
+                if is_legal(sq, low):
+                    out.append(SQUARES[sq] + SQUARES[target])
+
+        # Превращения без взятия
+        step = 8 * PAWN_DIRECTIONS[color]
+        pawns = position.pieces[color][PAWN] & (0xFF << (8 * (PAWN_END_ROWS[color] - PAWN_DIRECTIONS[color])))
+        while pawns:
+            low = pawns & -pawns
+            pawns ^= low
+            sq = low.bit_length() - 1
+            target = 1 << (sq + step)
+            if not occupied & target and is_legal(sq, target):
+                out.append(SQUARES[sq] + SQUARES[sq + step])
+
+        return out
+
+    def get_position_status(self):
+        """Ходы текущего игрока и наличие шаха. Результат запоминается
+        для последней позиции (по ключу Зобриста), поэтому повторные
+        вызовы без изменения доски ничего не пересчитывают"""
+        key = self.zobrist_key()
+        if key != self.status_key:
+            self.status = (self.generate_legal_moves(), self.is_check())
+            self.status_key = key
+        return self.status
+
+    def legal_moves(self, color=None):
+        """То же, что moves_without_check"""
+        if color is None:
+            color = self.color
+
+        if color != self.color:
+            return []
+
+        moves, _ = self.get_position_status()
+        return list(moves)
+
     def is_checkmate(self):
-        return not self.moves_without_check(self.color)
+        """Нет ни одного хода (мат или пат)"""
+        moves, _ = self.get_position_status()
+        return not moves
+
+    def is_stalemate(self):
+        moves, check = self.get_position_status()
+        return not moves and not check
 
     def can_castle(self, row, col, row1, col1):
         piece1 = self.board[row][col]
@@ -695,8 +1163,8 @@ class ChessBoard(Board):
         elif not isinstance(piece2, (Rook, King)):
             return False
         else:
-            p1 = piece1.can_castle(self, row1, col1)
-            p2 = piece2.can_castle(self, row, col)
+            p1 = piece1.can_castle(self, row, col, row1, col1)
+            p2 = piece2.can_castle(self, row1, col1, row, col)
             return p1 and p2
 
     def promote(self, row, col, char):
@@ -706,13 +1174,13 @@ class ChessBoard(Board):
             return False
         elif not isinstance(piece, Pawn):
             return False
-        elif not piece.can_promote(self):
+        elif not piece.can_promote(row):
             return False
         elif self.pieces_chars[char.upper()] == King:
             return False
 
         new_piece = self.pieces_chars.get(char.upper()[0], Pawn)
-        self.board[row][col] = new_piece(self.color)
+        self.set_piece(row, col, new_piece(self.color))
         return True
 
     def move_piece(self, row, col, row1, col1, autopromote=False):
@@ -729,15 +1197,15 @@ class ChessBoard(Board):
                 (row, col): piece,
                 (row1, col1): self.board[row1][col1]
             }
+            unmoved = [x for x in old if not self.has_moved(*x)]
 
-            self.board[row][col] = None  # Снять фигуру.
-            self.board[row1][col1] = piece  # Поставить на новое место.
+            # Снять фигуру и поставить на новое место: перемещённая
+            # ладья или король считается ходившей (см. set_piece)
+            self.set_piece(row, col, None)
+            self.set_piece(row1, col1, piece)
 
-            piece = self.get_piece(row1, col1)
-            if isinstance(piece, (Rook, King)):
-                piece.set_has_moved()
-            elif isinstance(piece, Pawn):
-                if piece.can_promote(self):
+            if isinstance(piece, Pawn):
+                if piece.can_promote(row1):
                     if autopromote:
                         promote_char = 'Q'
                     else:
@@ -750,7 +1218,7 @@ class ChessBoard(Board):
                 (row1, col1): self.board[row1][col1]
             }
 
-            history_obj = HistoryObject(old, new, self.color)
+            history_obj = HistoryObject(old, new, self.color, unmoved)
             self.color = opponent(self.color)
             return history_obj
         elif self.can_castle(row, col, row1, col1):
@@ -762,18 +1230,17 @@ class ChessBoard(Board):
                 (row1, col1): piece2
             }
 
-            piece1.set_has_moved()
-            piece2.set_has_moved()
+            unmoved = [x for x in old if not self.has_moved(*x)]
 
-            self.board[row][col] = piece2
-            self.board[row1][col1] = piece1
+            self.set_piece(row, col, piece2)
+            self.set_piece(row1, col1, piece1)
 
             new = {
                 (row, col): piece2,
                 (row1, col1): piece1
             }
 
-            history_obj = HistoryObject(old, new, self.color)
+            history_obj = HistoryObject(old, new, self.color, unmoved)
             self.color = opponent(self.color)
             return history_obj
         else:
@@ -790,6 +1257,56 @@ class ChessBoard(Board):
             self.history_pos += 1
             return history_obj
 
+    def push(self, row, col, row1, col1):
+        """Сделать ход для поиска: без проверок, истории и вызова promotion_func
+        (пешка всегда превращается в ферзя). Ход должен быть из legal_moves,
+        рокировка не поддерживается. Отменяется методом pop"""
+        if self.search_ply == len(self.search_stack):
+            self.search_stack.append([None] * 10)
+        entry = self.search_stack[self.search_ply]
+        self.search_ply += 1
+
+        piece = self.board[row][col]
+        captured = self.board[row1][col1]
+        entry[8], entry[9] = self.unmoved, self.hash
+
+        self.set_piece(row, col, None)
+        self.set_piece(row1, col1, piece)
+
+        promoted = piece.kind == PAWN and row1 == PAWN_END_ROWS[piece.color]
+        if promoted:
+            self.set_piece(row1, col1, Queen(piece.color))
+
+        entry[0], entry[1], entry[2], entry[3] = row, col, row1, col1
+        entry[4], entry[5], entry[6], entry[7] = piece, captured, promoted, self.color
+
+        self.color = opponent(self.color)
+
+    def push_null(self):
+        """Пропустить ход (нулевой ход для поиска). Отменяется методом pop"""
+        if self.search_ply == len(self.search_stack):
+            self.search_stack.append([None] * 10)
+        entry = self.search_stack[self.search_ply]
+        self.search_ply += 1
+
+        entry[0], entry[7] = None, self.color
+        self.color = opponent(self.color)
+
+    def pop(self):
+        """Отменить последний ход, сделанный push или push_null"""
+        self.search_ply -= 1
+        row, col, row1, col1, piece, captured, promoted, color, unmoved, key = self.search_stack[self.search_ply]
+
+        if row is None:
+            self.color = color
+            return
+
+        self.set_piece(row, col, piece)
+        self.set_piece(row1, col1, captured)
+
+        self.unmoved, self.hash = unmoved, key
+        self.color = color
+
     def on_click(self, cell, button=LMB):
         if button == LMB:
             self.set_selected_cells([cell])
@@ -816,7 +1333,11 @@ class ChessBoard(Board):
         for key in obj.keys():
             row, col = key
             val = obj[key]
-            self.board[row][col] = val
+            self.set_piece(row, col, val)
+
+        if is_old:
+            for row, col in history_obj.unmoved:
+                self.set_has_moved(row, col, False)
 
     def undo(self, do_pop=False):
         if self.history:
@@ -1,11 +1,15 @@
+import threading
+import time
 from tkinter import Tk
 from tkinter import filedialog as fd
 
 import pygame
 
 import ai
+import book
 import chess
 import gui
+import parallel
 from chess import RMB, LMB
 
 BOARD_IMG = 'data/images/board.jpg'
@@ -25,7 +29,22 @@ OPEN_IMG = pygame.image.load(BUTTON_IMG_PATH + 'open.png')
 BOT_ON_IMG = pygame.image.load(BUTTON_IMG_PATH + 'bot_on.png')
 BOT_OFF_IMG = pygame.image.load(BUTTON_IMG_PATH + 'bot_off.png')
 
-AI_DEPTH = 2
+AI_MAX_DEPTH = 32
+# Алгоритм поиска ИИ: ai.MINIMAX, ai.NEGAMAX или ai.SMP
+AI_SEARCH = ai.NEGAMAX
+# Число процессов для ai.SMP (None --- по числу ядер)
+AI_SMP_WORKERS = None
+# ИИ тратит на ход долю AI_TIME_SHARE оставшегося на ход времени,
+# но не меньше AI_MIN_TIME и не больше AI_MAX_TIME секунд
+AI_TIME_SHARE = 0.05
+AI_MIN_TIME = 0.5
+AI_MAX_TIME = 5
+# Событие с ходом, найденным ИИ в фоновом потоке (см. Chess.make_ai_move)
+AI_MOVE_EVENT = pygame.USEREVENT + 2
+# Думать во время хода человека над позицией после предсказанного ответа
+AI_PONDER = True
+# Дебютная книга (собирается командой python book.py)
+AI_BOOK_PATH = book.BOOK_PATH
 
 
 class PromoteDialog:
@@ -192,6 +211,23 @@ class Chess:
             self.img = self.get_frame_img()
 
         self.is_ai_enabled = False
+        # Фоновый поиск хода ИИ: поток, его SearchControl и номер поиска.
+        # Ход от отменённого поиска (с другим номером) не делается
+        self.ai_thread = None
+        self.ai_control = None
+        self.ai_generation = 0
+        # Результат поиска (номер поиска, ход, главный вариант). Поток
+        # записывает его сюда, а событие AI_MOVE_EVENT только будит главный
+        # цикл: событие может потеряться (его заберёт, например, цикл
+        # PromoteDialog), а ход --- нет
+        self.ai_result = None
+        # Во время обдумывания на чужом времени: позиция после предсказанного
+        # хода человека и время начала поиска
+        self.ponder_snapshot = None
+        self.ponder_start = None
+        self.book = book.open_book(AI_BOOK_PATH)
+        # Процессы Lazy SMP запускаются один раз на всю игру
+        self.smp = parallel.LazySMPSearch(AI_SMP_WORKERS) if AI_SEARCH == ai.SMP else None
 
         self.turn_len = 120
         self.stopwatch_secs = self.turn_len
@@ -204,6 +240,7 @@ class Chess:
         if self.is_ai_enabled:
             self.ai_enabled_lbl.set_text('ИИ включен')
         else:
+            self.cancel_ai_move()
             self.ai_enabled_lbl.set_text('ИИ выключен')
 
     def write_to_file(self):
@@ -216,6 +253,7 @@ class Chess:
         file_name = fd.askopenfilename(filetypes=[("Txt files", "*.txt")])
 
         if file_name:
+            self.cancel_ai_move()
             try:
                 self.chess_board.read_from_file(file_name)
             except Exception as error:
@@ -225,16 +263,19 @@ class Chess:
         self.turn_history_box.clear()
 
     def undo(self):
+        self.cancel_ai_move()
         self.chess_board.undo()
         self.stopwatch_secs = self.turn_len
         self.update_stopwatch_text()
 
     def redo(self):
+        self.cancel_ai_move()
         self.chess_board.redo()
         self.stopwatch_secs = self.turn_len
         self.update_stopwatch_text()
 
     def reset(self):
+        self.cancel_ai_move()
         self.chess_board.reset()
 
         self.turn_history_box.clear()
@@ -264,6 +305,7 @@ class Chess:
             self.update_stopwatch_text()
 
             if self.stopwatch_secs == 0:
+                self.cancel_ai_move()
                 self.stopwatch_secs = self.turn_len
                 self.change_turn()
 
@@ -326,22 +368,143 @@ class Chess:
         self.gui_group.get_mouse_up(mouse_pos)
 
     def make_ai_move(self):
+        """Начать поиск хода ИИ в фоновом потоке на копии доски. Найденный
+        ход записывается в ai_result и делается в apply_ai_move.
+        Если человек сделал предсказанный ход, продолжается поиск, начатый
+        на его времени (см. start_pondering)"""
+        if self.ponder_snapshot is not None and self.chess_board.to_snapshot() == self.ponder_snapshot:
+            self.ponder_hit()
+            return
+
+        self.cancel_ai_move()
+
         if self.chess_board.color == chess.WHITE:
-            is_maximising = True
             print('AI Playing as White!')
         else:
-            is_maximising = False
             print('AI Playing as Black!')
 
-        best_move = ai.minimax_root(AI_DEPTH, self.chess_board, is_maximising)
-
-        history_obj = self.chess_board.make_move(*best_move, True)
+        if self.book is not None:
+            move = self.book.choose(self.chess_board)
+            if move is not None:
+                print('Book move', chess.to_chess_notation(move[:2]) + '-' + chess.to_chess_notation(move[2:]))
+                self.play_ai_move(move, [move])
+                return
+
+        self.start_search(self.chess_board.clone(), self.get_ai_time())
+
+    def start_search(self, board, time_limit):
+        self.ai_control = ai.SearchControl(time_limit)
+        self.ai_thread = threading.Thread(target=self.search_ai_move,
+                                          args=(board, self.ai_control, self.ai_generation), daemon=True)
+        self.ai_thread.start()
+
+    def start_pondering(self, pv):
+        """Начать поиск без ограничения времени в позиции после хода pv[1] ---
+        ответа человека, который ИИ считает лучшим"""
+        if not AI_PONDER or not self.is_ai_enabled or len(pv) < 2:
+            return
+        if pv[1] not in self.chess_board.legal_moves():
+            return
+
+        board = self.chess_board.clone()
+        board.push(*pv[1])
+        board.search_ply = 0
+        if not board.legal_moves():
+            return
+
+        self.ponder_snapshot = board.to_snapshot()
+        self.ponder_start = time.perf_counter()
+        self.start_search(board, None)
+
+    def ponder_hit(self):
+        """Человек сделал предсказанный ход: время, потраченное на обдумывание,
+        засчитывается в счёт хода ИИ, так что он отвечает быстрее, а не думает
+        дольше. Уже готовый ход делается сразу"""
+        self.ponder_snapshot = None
+        if self.ai_result is not None:
+            pygame.event.post(pygame.event.Event(AI_MOVE_EVENT))
+        else:
+            elapsed = time.perf_counter() - self.ponder_start
+            self.ai_control.set_time_limit(max(self.get_ai_time() - elapsed, 0))
+
+    def is_ai_thinking(self):
+        return self.ai_thread is not None and self.ponder_snapshot is None
+
+    def close(self):
+        """Остановить ИИ и освободить его ресурсы в конце игры"""
+        self.cancel_ai_move()
+        if self.smp is not None:
+            self.smp.close()
+            self.smp = None
+        if self.book is not None:
+            self.book.close()
+            self.book = None
+
+    def cancel_ai_move(self):
+        if self.ai_thread is not None:
+            self.ai_control.stop()
+            # Поиск проверяет остановку каждые ai.CHECK_INTERVAL узлов
+            self.ai_thread.join()
+            self.ai_thread = None
+            self.ai_control = None
+        self.ponder_snapshot = None
+        self.ai_result = None
+        self.ai_generation += 1
+
+    def search_ai_move(self, board, control, generation):
+        """Поиск хода ИИ (выполняется в фоновом потоке)"""
+        start = time.perf_counter()
+        if self.smp is not None:
+            best_move, depth, nodes, pv = self.smp.search(board, None, AI_MAX_DEPTH, control=control)
+        else:
+            best_move, depth, nodes, pv = ai.iterative_deepening(board, board.color == chess.WHITE, None,
+                                                                 AI_MAX_DEPTH, method=AI_SEARCH, control=control)
+        if control.stopped:
+            return
+
+        elapsed = time.perf_counter() - start
+        pv_text = ' '.join(chess.to_chess_notation(m[:2]) + '-' + chess.to_chess_notation(m[2:]) for m in pv)
+        print(f'{AI_SEARCH}: depth {depth}, {nodes} nodes in {elapsed:.1f} s, PV: {pv_text}')
+        # Статистику общей таблицы собирают процессы Lazy SMP, здесь её нет
+        if self.smp is None:
+            print('Transposition table:', ai.TRANSPOSITION_TABLE.stats())
+
+        self.ai_result = generation, best_move, pv
+        pygame.event.post(pygame.event.Event(AI_MOVE_EVENT))
+
+    def apply_ai_move(self):
+        if self.ai_result is None or self.ai_thread is None:
+            return
+        generation, move, pv = self.ai_result
+        if generation != self.ai_generation:
+            return
+
+        # Поиск на чужом времени дошёл до AI_MAX_DEPTH раньше, чем человек
+        # сделал ход: результат ждёт в ai_result до ponder_hit
+        if self.ponder_snapshot is not None:
+            return
+
+        self.ai_thread.join()
+        self.ai_thread = None
+        self.ai_control = None
+        self.ai_result = None
+
+        self.play_ai_move(move, pv)
+
+    def play_ai_move(self, move, pv):
+        history_obj = self.chess_board.make_move(*move, True)
 
         self.update_game(history_obj)
 
         self.stopwatch_secs = self.turn_len
         self.update_stopwatch_text()
 
+        if isinstance(history_obj, chess.HistoryObject) and not self.chess_board.is_checkmate():
+            self.start_pondering(pv)
+
+    def get_ai_time(self):
+        return min(max(self.stopwatch_secs * AI_TIME_SHARE, AI_MIN_TIME), AI_MAX_TIME)
+
     def change_turn(self):
         self.chess_board.color = chess.opponent(self.chess_board.color)
         if self.chess_board.color == chess.WHITE:
@@ -379,6 +542,10 @@ class Chess:
     def get_click(self, mouse_pos, button=LMB):
         self.gui_group.get_click(mouse_pos)
 
+        # Пока ИИ думает, фигуры не двигаются
+        if self.is_ai_thinking():
+            return None
+
         mx, my = mouse_pos
         mpos = mx - self.chess_x, my - self.y - self.chess_y
 
@@ -462,6 +629,9 @@ def main():
             if event.type == STOPWATCH_TICK:
                 chessb.tick_stopwatch()
                 has_interacted = True
+            if event.type == AI_MOVE_EVENT:
+                chessb.apply_ai_move()
+                has_interacted = True
 
         if has_interacted or is_checkmate:
             screen.fill(pygame.Color('white'))
@@ -484,7 +654,9 @@ def main():
         if not is_checkmate:
             game_over.hide()
 
-    clock.tick(10)
+        clock.tick(10)
+
+    chessb.close()
 
 
 pygame.quit()
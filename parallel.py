@@ -0,0 +1,244 @@
+import os
+import random
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import shared_memory
+
+import ai
+import chess
+from tt import TranspositionTable, BUCKET_SIZE, MAX_AGE
+
+# Размер таблицы позиций в каждом процессе пула
+WORKER_TT_SIZE_MB = 4
+
+# Состояние процесса пула: своя доска, таблица позиций и порядок ходов
+_board = None
+_tt = None
+_ordering = None
+_search_id = None
+
+
+def init_worker():
+    global _board, _tt, _ordering
+    _board = chess.ChessBoard(None, None)
+    ai.init_evaluation(_board)
+    _tt = TranspositionTable(WORKER_TT_SIZE_MB)
+    _ordering = ai.MoveOrdering()
+
+
+def search_move(snapshot, move, depth_left, is_maximising_player, alpha, beta, search_id):
+    """Оценка хода move из позиции snapshot, как в minimax_root.
+    Выполняется в процессе пула. Возвращает (оценка, число узлов)"""
+    global _search_id, _ordering
+    # Таблица позиций общая только для ходов одного поиска
+    if search_id != _search_id:
+        _tt.clear()
+        _ordering = ai.MoveOrdering()
+        _search_id = search_id
+
+    _board.set_snapshot(snapshot)
+    control = ai.SearchControl()
+
+    _board.push(*move)
+    value = ai.minimax_eval(depth_left - 1, _board, alpha, beta, not is_maximising_player, _tt, control,
+                            _ordering)
+    _board.pop()
+
+    return value, control.nodes
+
+
+class ParallelSearch:
+    """Поиск с разделением ходов из корня между процессами пула. В процессы
+    передаётся только снимок позиции (chess.Snapshot) и ход.
+    Это minimax_root на фиксированную глубину без ограничения времени:
+    он нужен для сравнения с последовательным поиском (bench.py parallel),
+    в игре многоядерный поиск --- LazySMPSearch (ai.SMP)"""
+
+    def __init__(self, workers=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(self.workers, initializer=init_worker)
+        self.search_id = 0
+        self.nodes = 0
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, snapshot, move, depth_left, is_maximising_player, alpha, beta):
+        return self.executor.submit(search_move, snapshot, move, depth_left, is_maximising_player,
+                                    alpha, beta, self.search_id)
+
+    def root(self, depth_left, game, is_maximising_player):
+        """То же, что ai.minimax_root со свежими таблицей позиций и MoveOrdering:
+        первый ход ищется с полным окном, остальные --- параллельно в окне,
+        ограниченном его оценкой. Из ходов с лучшей оценкой выбирается
+        первый по порядку, поэтому ход совпадает с последовательным поиском"""
+        self.search_id += 1
+        self.nodes = 0
+
+        ai.init_evaluation(game)
+        moves = ai.MoveOrdering().order(game, game.legal_moves(), depth_left=depth_left)
+        snapshot = game.to_snapshot()
+
+        best_move_found = moves[0]
+        best_move, nodes = self.submit(snapshot, best_move_found, depth_left, is_maximising_player,
+                                       -ai.INF, ai.INF).result()
+        self.nodes += nodes
+
+        # Ход не лучше первого отсекается с оценкой, равной границе окна
+        if is_maximising_player:
+            alpha, beta = best_move, ai.INF
+        else:
+            alpha, beta = -ai.INF, best_move
+        futures = [self.submit(snapshot, move, depth_left, is_maximising_player, alpha, beta)
+                   for move in moves[1:]]
+
+        for move, future in zip(moves[1:], futures):
+            value, nodes = future.result()
+            self.nodes += nodes
+
+            if value > best_move and is_maximising_player:
+                best_move = value
+                best_move_found = move
+            elif value < best_move and not is_maximising_player:
+                best_move = value
+                best_move_found = move
+
+        return best_move_found
+
+
+# Lazy SMP: все процессы ищут одну и ту же позицию итеративным углублением
+# и делят таблицу позиций в общей памяти. Первые SMP_HEADER байт общей
+# памяти --- флаг остановки (байт 0) и срок поиска по time.time() (DEADLINE,
+# 0 --- без ограничения), дальше --- записи таблицы (см. tt.py: каждая
+# запись проверяется по ключу, поэтому запись без блокировок безопасна,
+# недописанная запись просто не найдётся)
+SMP_HEADER = 16
+SMP_TT_SIZE_MB = 64
+DEADLINE = struct.Struct('<d')
+DEADLINE_OFFSET = 8
+# Как часто (в секундах) главный процесс проверяет остановку и срок поиска
+SMP_POLL_INTERVAL = 0.05
+
+_shared = None
+
+
+def init_smp_worker(name):
+    global _shared, _board, _tt
+    # Общую память удаляет создавший её процесс (LazySMPSearch.close)
+    _shared = shared_memory.SharedMemory(name=name)
+    _board = chess.ChessBoard(None, None)
+    ai.init_evaluation(_board)
+    _tt = TranspositionTable(buffer=_shared.buf[SMP_HEADER:])
+
+
+class SharedControl(ai.SearchControl):
+    """SearchControl, который останавливается по флагу и сроку из общей
+    памяти: их выставляет главный процесс (LazySMPSearch.search)"""
+
+    def __init__(self, buffer):
+        super().__init__()
+        self.buffer = buffer
+
+    def timed_out(self):
+        if self.buffer[0]:
+            return True
+        deadline = DEADLINE.unpack_from(self.buffer, DEADLINE_OFFSET)[0]
+        return self.timed and deadline > 0 and time.time() >= deadline
+
+
+def smp_search(snapshot, index, max_depth, age, method):
+    """Итеративное углубление в процессе index. Процессы отличаются порядком
+    тихих ходов (случайная начальная таблица истории) и начальной глубиной,
+    поэтому просматривают разные части дерева и дополняют друг другу таблицу.
+    Возвращает (глубина, ход, число узлов, главный вариант)"""
+    _board.set_snapshot(snapshot)
+    # Поколение таблицы задаёт главный процесс, а iterative_deepening
+    # ещё раз вызовет new_search()
+    _tt.age = (age - 1) % MAX_AGE
+    _tt.reset_stats()
+
+    ordering = ai.MoveOrdering()
+    if index:
+        rng = random.Random(index)
+        ordering.history = [rng.randrange(8) for _ in ordering.history]
+    # new_search() в iterative_deepening делит историю пополам
+    ordering.history = [x * 2 for x in ordering.history]
+
+    control = SharedControl(_shared.buf)
+    first_depth = 1 + index % 2
+    best_move, depth, nodes, pv = ai.iterative_deepening(_board, _board.color == chess.WHITE, None,
+                                                         max_depth, _tt, ordering, method, control,
+                                                         min(first_depth, max_depth))
+    return depth, best_move, nodes, pv
+
+
+class LazySMPSearch:
+    """Lazy SMP поиск в workers процессах с общей таблицей позиций"""
+
+    def __init__(self, workers=None, tt_size_mb=SMP_TT_SIZE_MB):
+        self.workers = workers or os.cpu_count() or 1
+        buckets = max(1, int(tt_size_mb * 1024 * 1024) // BUCKET_SIZE)
+        self.shared = shared_memory.SharedMemory(create=True, size=SMP_HEADER + buckets * BUCKET_SIZE)
+        self.shared.buf[:SMP_HEADER] = bytes(SMP_HEADER)
+        self.tt = TranspositionTable(buffer=self.shared.buf[SMP_HEADER:])
+        self.executor = ProcessPoolExecutor(self.workers, initializer=init_smp_worker,
+                                            initargs=(self.shared.name,))
+        self.nodes = 0
+        self.elapsed = 0
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.tt.buffer.release()
+        self.shared.close()
+        self.shared.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def set_deadline(self, deadline):
+        """Передать процессам срок поиска (по time.perf_counter, как
+        SearchControl.deadline)"""
+        value = 0 if deadline is None else time.time() + deadline - time.perf_counter()
+        DEADLINE.pack_into(self.shared.buf, DEADLINE_OFFSET, value)
+
+    def search(self, game, time_limit=None, max_depth=ai.MAX_DEPTH, method=ai.NEGAMAX, control=None):
+        """Искать позицию game, пока не выйдет время или один из процессов не
+        досчитает до max_depth. Время и остановку задаёт control (по
+        умолчанию --- SearchControl(time_limit)); его срок можно менять во
+        время поиска, как в iterative_deepening. Возвращает ход самой глубокой
+        законченной итерации, эту глубину, общее число узлов и главный вариант"""
+        if control is None:
+            control = ai.SearchControl(time_limit)
+        start = time.perf_counter()
+        self.tt.new_search()
+        self.shared.buf[0] = 0
+        self.set_deadline(control.deadline)
+        snapshot = game.to_snapshot()
+
+        futures = [self.executor.submit(smp_search, snapshot, index, max_depth, self.tt.age, method)
+                   for index in range(self.workers)]
+        while not wait(futures, timeout=SMP_POLL_INTERVAL, return_when=FIRST_COMPLETED)[0]:
+            if control.stopped:
+                break
+            self.set_deadline(control.deadline)
+        # Первый закончивший процесс дошёл до max_depth (или вышло время): остальные останавливаются
+        self.shared.buf[0] = 1
+
+        results = [future.result() for future in futures]
+        self.nodes = control.nodes = sum(result[2] for result in results)
+        # Самая глубокая итерация; при равенстве --- процесс с меньшим номером.
+        # Глубина 0 --- процесс не закончил ни одной итерации, его ход не просчитан
+        finished = [result for result in results if result[0]] or results
+        depth, best_move, _, pv = max(finished, key=lambda result: result[0])
+        self.elapsed = time.perf_counter() - start
+        return best_move, depth, self.nodes, pv
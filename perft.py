@@ -0,0 +1,126 @@
+import argparse
+import sys
+import time
+
+import chess
+
+# Эталонные позиции и число узлов perft на каждой глубине
+# (рокировка в список ходов не входит, взятия на проходе нет)
+PERFT_SUITE = [
+    ('data/saves/perft/start.txt', {1: 20, 2: 400, 3: 8902, 4: 197367}),
+    ('data/saves/perft/middlegame.txt', {1: 41, 2: 1384, 3: 56232, 4: 1910679}),
+    ('data/saves/perft/pins.txt', {1: 22, 2: 942, 3: 21552, 4: 846446}),
+    ('data/saves/perft/promotion.txt', {1: 6, 2: 75, 3: 522, 4: 7135}),
+    ('data/saves/examples/promote.txt', {1: 4, 2: 16, 3: 68, 4: 266}),
+]
+
+GENERATORS = ('legal_moves', 'moves_without_check')
+
+
+def load_board(filename):
+    board = chess.ChessBoard(None, None)
+    board.read_from_file(filename)
+    return board
+
+
+def move_str(move):
+    row, col, row1, col1 = move
+    return chess.to_chess_notation((row, col)).lower() + '-' + chess.to_chess_notation((row1, col1)).lower()
+
+
+def make_move(board, move, use_history):
+    if use_history:
+        board.make_move(*move, True)
+    else:
+        board.push(*move)
+
+
+def unmake_move(board, use_history):
+    if use_history:
+        board.undo(True)
+    else:
+        board.pop()
+
+
+def perft(board, depth, generator='legal_moves', use_history=False):
+    """Число позиций, достижимых из данной ровно за depth полуходов"""
+    moves = getattr(board, generator)()
+    if depth == 1:
+        return len(moves)
+
+    nodes = 0
+    for move in moves:
+        make_move(board, move, use_history)
+        nodes += perft(board, depth - 1, generator, use_history)
+        unmake_move(board, use_history)
+
+    return nodes
+
+
+def divide(board, depth, generator='legal_moves', use_history=False):
+    """perft, разбитый по ходам из корневой позиции"""
+    out = []
+    for move in getattr(board, generator)():
+        make_move(board, move, use_history)
+        nodes = perft(board, depth - 1, generator, use_history) if depth > 1 else 1
+        unmake_move(board, use_history)
+        out.append((move, nodes))
+    return out
+
+
+def run(filename, depth, generator='legal_moves', show_divide=False, expected=None, use_history=False):
+    board = load_board(filename)
+
+    start = time.perf_counter()
+    if show_divide:
+        results = divide(board, depth, generator, use_history)
+        nodes = sum(x for _, x in results)
+    else:
+        results = []
+        nodes = perft(board, depth, generator, use_history) if depth > 0 else 1
+    elapsed = time.perf_counter() - start
+
+    for move, count in results:
+        print(f'  {move_str(move)}: {count}')
+
+    nps = nodes / elapsed if elapsed > 0 else 0
+    line = f'{filename} depth {depth}: {nodes} nodes, {elapsed:.3f} s, {nps:.0f} nodes/s'
+
+    ok = True
+    if expected is not None:
+        ok = nodes == expected
+        line += ' OK' if ok else f' FAIL (expected {expected})'
+
+    print(line)
+    return ok
+
+
+def run_suite(max_depth, generator='legal_moves', use_history=False):
+    ok = True
+    for filename, counts in PERFT_SUITE:
+        for depth in sorted(counts):
+            if depth <= max_depth:
+                ok = run(filename, depth, generator, expected=counts[depth], use_history=use_history) and ok
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Perft: подсчёт позиций для проверки генератора ходов')
+    parser.add_argument('file', nargs='?', help='файл с позицией; без него проверяются все эталонные позиции')
+    parser.add_argument('-d', '--depth', type=int, default=3)
+    parser.add_argument('--divide', action='store_true', help='вывести число узлов для каждого хода из корня')
+    parser.add_argument('-g', '--generator', choices=GENERATORS, default='legal_moves')
+    parser.add_argument('--history', action='store_true',
+                        help='делать ходы через make_move/undo вместо push/pop')
+    args = parser.parse_args()
+
+    if args.file:
+        ok = run(args.file, args.depth, args.generator, args.divide, use_history=args.history)
+    else:
+        ok = run_suite(args.depth, args.generator, args.history)
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+import mmap
+import os
+
+from bitboard import PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, lsb
+from chess import WHITE, BLACK, opponent
+
+# Таблицы окончаний без пешек, построенные ретроградным анализом (tbgen.py).
+# Набор фигур называется строкой вроде KRKN: сначала фигуры белых, потом
+# чёрных, каждая сторона начинается с короля, фигуры в порядке KIND_CHARS.
+# Более сильная сторона всегда записывается первой (KRKN, а не KNKR):
+# без пешек правила не зависят от цвета, и позиция с переставленными
+# цветами ищется в той же таблице.
+# Пешки сознательно не поддерживаются: пешка ходит только вперёд, поэтому
+# для них не годятся ни перестановка цветов, ни повороты доски (остаётся
+# одно отражение по вертикали), а превращение ведёт в таблицы без пешек.
+# Это отдельная раскладка файла и отдельный генератор; позиции с пешками
+# probe() пропускает, и их считает обычный поиск.
+#
+# Файл NAME.bin --- по байту на позицию. Позиции упорядочены по очереди
+# хода (белые, чёрные), клетке первого короля --- только 10 клеток
+# треугольника TRIANGLE, остальные получаются поворотами и отражениями
+# доски (TRANSFORMS), --- и клеткам остальных фигур в порядке имени.
+# Байт: DRAW, нечётный b --- ходящий ставит мат за b полуходов, чётный b ---
+# получает мат (или остаётся без ходов) через b - 2 полухода, ILLEGAL ---
+# невозможная позиция (фигуры на одной клетке или ходящий бьёт короля)
+TABLEBASE_PATH = 'data/tablebases'
+KIND_CHARS = 'KQRBN'
+CHAR_KINDS = {'K': KING, 'Q': QUEEN, 'R': ROOK, 'B': BISHOP, 'N': KNIGHT}
+MAX_PIECES = 4
+
+DRAW = 0
+ILLEGAL = 255
+MAX_PLIES = 253
+
+WIN, LOSS = 1, -1
+
+
+def _transform(sq, index):
+    row, col = sq // 8, sq % 8
+    if index & 4:
+        row, col = col, row
+    if index & 1:
+        col = 7 - col
+    if index & 2:
+        row = 7 - row
+    return row * 8 + col
+
+
+# Восемь симметрий доски: TRANSFORMS[i][sq] --- образ клетки sq.
+# Все фигуры, кроме пешек, ходят одинаково на повёрнутой доске
+TRANSFORMS = [[_transform(sq, index) for sq in range(64)] for index in range(8)]
+TRIANGLE = [row * 8 + col for row in range(4) for col in range(row, 4)]
+TRIANGLE_INDEX = {sq: index for index, sq in enumerate(TRIANGLE)}
+# Номер симметрии, переводящей клетку первого короля в треугольник
+KING_TRANSFORM = [next(index for index in range(8) if TRANSFORMS[index][sq] in TRIANGLE_INDEX)
+                  for sq in range(64)]
+
+
+def side_key(side):
+    """Чем меньше, тем сильнее сторона: сначала по числу фигур, потом по их ценности"""
+    return -len(side), [KIND_CHARS.index(char) for char in side]
+
+
+def canonical_name(white, black):
+    """(имя таблицы, поменяны ли цвета) для фигур белых white и чёрных black
+    (строки вида 'KR' в порядке KIND_CHARS)"""
+    if side_key(black) < side_key(white):
+        return black + white, True
+    return white + black, False
+
+
+def split_name(name):
+    """'KRKN' -> ('KR', 'KN')"""
+    index = name.index('K', 1)
+    return name[:index], name[index:]
+
+
+def table_size(name):
+    return 2 * len(TRIANGLE) * 64 ** (len(name) - 1)
+
+
+def encode(value):
+    """Байт для оценки (WIN/LOSS/0, число полуходов до мата)"""
+    wdl, plies = value
+    if wdl == WIN:
+        return plies
+    if wdl == LOSS:
+        return plies + 2
+    return DRAW
+
+
+def decode(code):
+    if code == DRAW:
+        return 0, 0
+    if code % 2:
+        return WIN, code
+    return LOSS, code - 2
+
+
+class Tablebases:
+    """Таблицы окончаний из каталога directory, отображённые в память"""
+
+    def __init__(self, directory=TABLEBASE_PATH):
+        self.tables = {}
+        self.files = []
+        if os.path.isdir(directory):
+            for filename in sorted(os.listdir(directory)):
+                name, ext = os.path.splitext(filename)
+                if ext != '.bin':
+                    continue
+                file = open(os.path.join(directory, filename), 'rb')
+                if os.fstat(file.fileno()).st_size != table_size(name):
+                    file.close()
+                    continue
+                self.files.append(file)
+                self.tables[name] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.max_pieces = max((len(name) for name in self.tables), default=0)
+
+    def close(self):
+        for table in self.tables.values():
+            table.close()
+        for file in self.files:
+            file.close()
+        self.tables = {}
+        self.files = []
+        self.max_pieces = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.tables)
+
+    def probe(self, game):
+        """(WIN/LOSS/0, полуходов до мата) для ходящей стороны или None,
+        если таблицы для позиции нет"""
+        position = game.bitboards
+        occupied = position.get_occupied()
+        if bin(occupied).count('1') > self.max_pieces:
+            return None
+        if position.pieces[WHITE][PAWN] or position.pieces[BLACK][PAWN]:
+            return None
+
+        sides = []
+        for color in (WHITE, BLACK):
+            chars, squares = '', []
+            for char in KIND_CHARS:
+                bb = position.pieces[color][CHAR_KINDS[char]]
+                while bb:
+                    sq = lsb(bb)
+                    chars += char
+                    squares.append(sq)
+                    bb &= bb - 1
+            sides.append((chars, squares))
+
+        color = game.color
+        name, swapped = canonical_name(sides[WHITE][0], sides[BLACK][0])
+        if swapped:
+            sides.reverse()
+            color = opponent(color)
+        table = self.tables.get(name)
+        if table is None:
+            return None
+
+        squares = sides[0][1] + sides[1][1]
+        if len(squares) != len(name):
+            # Нет короля
+            return None
+        transform = TRANSFORMS[KING_TRANSFORM[squares[0]]]
+        index = color * len(TRIANGLE) + TRIANGLE_INDEX[transform[squares[0]]]
+        for sq in squares[1:]:
+            index = index * 64 + transform[sq]
+
+        code = table[index]
+        if code == ILLEGAL:
+            return None
+        return decode(code)
+
+    def best_move(self, game):
+        """Лучший по таблицам ход: самый быстрый мат, иначе ничья, иначе
+        самое долгое сопротивление. None, если позиции или какого-то из
+        ходов нет в таблицах"""
+        best, best_key = None, None
+        for move in game.legal_moves():
+            game.push(*move)
+            value = self.probe(game)
+            game.pop()
+            if value is None:
+                return None
+
+            wdl, plies = value
+            # Оценка ответа --- с точки зрения соперника
+            if wdl == LOSS:
+                key = 2, -plies
+            elif wdl == WIN:
+                key = 0, plies
+            else:
+                key = 1, 0
+            if best_key is None or key > best_key:
+                best, best_key = move, key
+        return best
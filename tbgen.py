@@ -0,0 +1,344 @@
+import argparse
+import os
+import time
+
+import numpy as np
+
+from bitboard import KNIGHT, BISHOP, ROOK, QUEEN, KING, KNIGHT_ATTACKS, KING_ATTACKS, BETWEEN, ROOK_LINES, \
+    BISHOP_LINES
+from chess import WHITE, BLACK, opponent
+from tablebase import TABLEBASE_PATH, KIND_CHARS, CHAR_KINDS, MAX_PIECES, ILLEGAL, MAX_PLIES, TRIANGLE, \
+    TRIANGLE_INDEX, TRANSFORMS, KING_TRANSFORM, canonical_name, split_name
+
+# Наборы фигур по умолчанию. Взятие переводит позицию в набор поменьше,
+# поэтому таблицы строятся от меньших к большим (недостающие строятся сами)
+MATERIALS = ['KK', 'KQK', 'KRK', 'KBK', 'KNK',
+             'KQQK', 'KQRK', 'KQBK', 'KQNK', 'KRRK', 'KRBK', 'KRNK', 'KBBK', 'KBNK', 'KNNK',
+             'KQKQ', 'KQKR', 'KQKB', 'KQKN', 'KRKR', 'KRKB', 'KRKN', 'KBKB', 'KBKN', 'KNKN']
+
+# Во время построения оценка позиции --- int16 с точки зрения ходящего:
+# 0 --- ещё не известна (в конце --- ничья), v > 0 --- мат за v полуходов,
+# v < 0 --- мат ходящему через -v - 1 полуходов. Невозможные позиции
+# отмечаются отдельным массивом illegal. В массивах позиций по оси на
+# фигуру, как в файле таблицы: первый король стоит только в клетках TRIANGLE
+
+SQUARES = np.arange(64)
+KIND_NAMES = {kind: char for char, kind in CHAR_KINDS.items()}
+
+
+def _bb_matrix(table):
+    """Матрица (64, 64): m[a, b] --- есть ли клетка b в битборде table[a]"""
+    return np.array([[table[a] >> b & 1 for b in range(64)] for a in range(64)], dtype=bool)
+
+
+def _rays(offsets, slide):
+    rays = []
+    for dr, dc in offsets:
+        ray = []
+        for distance in range(1, 8 if slide else 2):
+            dest = np.full(64, -1)
+            for sq in range(64):
+                row, col = sq // 8 + dr * distance, sq % 8 + dc * distance
+                if 0 <= row < 8 and 0 <= col < 8:
+                    dest[sq] = row * 8 + col
+            ray.append(dest)
+        rays.append(ray)
+    return rays
+
+
+ROOK_OFFSETS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+BISHOP_OFFSETS = ((1, 1), (1, -1), (-1, 1), (-1, -1))
+KNIGHT_OFFSETS = ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2))
+
+# Лучи ходов каждой фигуры: у прыгающих фигур --- по одной клетке
+# (король ходит только по вертикали и горизонтали, как в bitboard.KING_ATTACKS)
+RAYS = {
+    KING: _rays(ROOK_OFFSETS, False),
+    KNIGHT: _rays(KNIGHT_OFFSETS, False),
+    BISHOP: _rays(BISHOP_OFFSETS, True),
+    ROOK: _rays(ROOK_OFFSETS, True),
+    QUEEN: _rays(ROOK_OFFSETS + BISHOP_OFFSETS, True),
+}
+
+LEAPER_ATTACKS = {KING: _bb_matrix(KING_ATTACKS), KNIGHT: _bb_matrix(KNIGHT_ATTACKS)}
+_ROOK_LINES = _bb_matrix(ROOK_LINES)
+_BISHOP_LINES = _bb_matrix(BISHOP_LINES)
+SLIDER_LINES = {ROOK: _ROOK_LINES, BISHOP: _BISHOP_LINES, QUEEN: _ROOK_LINES | _BISHOP_LINES}
+# BETWEEN_MATRIX[a, b, c] --- клетка c строго между a и b
+BETWEEN_MATRIX = np.array([_bb_matrix(BETWEEN[a]) for a in range(64)])
+
+
+def parse_material(name):
+    """Фигуры набора по осям таблицы: список (цвет, вид)"""
+    if len(name) > MAX_PIECES:
+        raise ValueError(f'Таблицы строятся не больше чем для {MAX_PIECES} фигур')
+    white, black = split_name(name)
+    canonical, _ = canonical_name(white, black)
+    if name != canonical:
+        raise ValueError(f'Набор {name} записывается как {canonical}')
+    return [(WHITE, CHAR_KINDS[char]) for char in white] + [(BLACK, CHAR_KINDS[char]) for char in black]
+
+
+def positions_shape(n):
+    return (len(TRIANGLE),) + (64,) * (n - 1)
+
+
+def expand(array, n, axes):
+    """Массив с осями размера 64 в порядке axes -> форма для массива позиций
+    из n фигур (остальные оси размера 1, ось первого короля --- TRIANGLE)"""
+    order = np.argsort(axes)
+    array = np.transpose(array, order)
+    shape = [1] * n
+    for axis in axes:
+        shape[axis] = 64
+    array = array.reshape(shape)
+    if 0 in axes:
+        array = array[TRIANGLE]
+    return array
+
+
+def take_child(array, i, dest):
+    """Значения array в позициях после хода фигуры на оси i в клетку dest[клетка
+    фигуры]. Если ходит первый король и уходит из треугольника, позиция
+    поворачивается обратно"""
+    if i:
+        return np.take(array, dest, axis=i)
+
+    n = array.ndim
+    out = np.empty_like(array)
+    for index, sq in enumerate(TRIANGLE):
+        target = dest[sq]
+        transform = TRANSFORMS[KING_TRANSFORM[target]]
+        out[index] = array[TRIANGLE_INDEX[transform[target]]][np.ix_(*[transform] * (n - 1))]
+    return out
+
+
+def attacks(pieces, i, target):
+    """Бьёт ли фигура на оси i клетку фигуры на оси target"""
+    n = len(pieces)
+    kind = pieces[i][1]
+    if kind in LEAPER_ATTACKS:
+        return expand(LEAPER_ATTACKS[kind], n, (i, target))
+
+    out = expand(SLIDER_LINES[kind], n, (i, target))
+    for j in range(n):
+        if j not in (i, target):
+            out = out & ~expand(BETWEEN_MATRIX, n, (i, target, j))
+    return out
+
+
+def illegal_positions(pieces, stm):
+    """Фигуры на одной клетке или ходящий stm может взять короля"""
+    n = len(pieces)
+    out = np.zeros(positions_shape(n), dtype=bool)
+    eye = np.eye(64, dtype=bool)
+    for a in range(n):
+        for b in range(a + 1, n):
+            out |= expand(eye, n, (a, b))
+
+    king = pieces.index((opponent(stm), KING))
+    for i, (color, _) in enumerate(pieces):
+        if color == stm:
+            out |= attacks(pieces, i, king)
+    return out
+
+
+def moves(pieces, stm):
+    """Все ходы стороны stm: (ось фигуры, клетка назначения для каждой клетки
+    фигуры, маска позиций, где ход возможен геометрически). Ход на занятую
+    клетку тоже входит: своя фигура там даёт невозможную позицию, чужая --- взятие"""
+    n = len(pieces)
+    for i, (color, kind) in enumerate(pieces):
+        if color != stm:
+            continue
+        for ray in RAYS[kind]:
+            blocked = np.zeros((1,) * n, dtype=bool)
+            for dest in ray:
+                valid = expand(dest >= 0, n, (i,)) & ~blocked
+                yield i, np.maximum(dest, 0), valid
+
+                # Дальше по лучу нельзя, если клетка занята любой фигурой
+                occupied = dest[:, None] == SQUARES[None, :]
+                for j in range(n):
+                    if j != i:
+                        blocked = blocked | expand(occupied, n, (i, j))
+
+
+class Generator:
+    """Построение таблиц в каталоге directory. Таблицы меньших наборов
+    хранятся в памяти целиком: на них ссылаются взятия в больших наборах"""
+
+    def __init__(self, directory=TABLEBASE_PATH, verbose=True):
+        self.directory = directory
+        self.verbose = verbose
+        self.tables = {}
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.bin')
+
+    def build(self, name):
+        """Построить таблицу набора name, если её ещё нет в каталоге"""
+        if not os.path.exists(self.path(name)):
+            self.save(name, *self.generate(name))
+
+    def get(self, name):
+        """(оценки, невозможные позиции) набора name для каждой очереди хода
+        на всех 64 клетках первого короля"""
+        if name not in self.tables:
+            self.build(name)
+            self.tables[name] = self.load(name)
+        return self.tables[name]
+
+    def sub_table(self, pieces, stm):
+        """Оценки и невозможные позиции набора pieces (после взятия) при ходе
+        stm, с осями в порядке pieces"""
+        def side(color):
+            axes = [i for i, piece in enumerate(pieces) if piece[0] == color]
+            return sorted(axes, key=lambda i: KIND_CHARS.index(KIND_NAMES[pieces[i][1]]))
+
+        white, black = side(WHITE), side(BLACK)
+        name, swapped = canonical_name(''.join(KIND_NAMES[pieces[i][1]] for i in white),
+                                       ''.join(KIND_NAMES[pieces[i][1]] for i in black))
+        if swapped:
+            white, black = black, white
+            stm = opponent(stm)
+
+        values, illegal = self.get(name)
+        canonical = white + black
+        order = [canonical.index(axis) for axis in range(len(pieces))]
+        return np.transpose(values[stm], order), np.transpose(illegal[stm], order)
+
+    def generate(self, name):
+        pieces = parse_material(name)
+        n = len(pieces)
+        shape = positions_shape(n)
+        start = time.perf_counter()
+
+        illegal = [illegal_positions(pieces, stm) for stm in (WHITE, BLACK)]
+        # Число ходов без взятий, ведущих в возможную позицию, и итоги взятий:
+        # самый быстрый мат через взятие, самое долгое поражение, есть ли ничья
+        counts, has_capture, capture_win, capture_loss, capture_draw = [], [], [], [], []
+        for stm in (WHITE, BLACK):
+            other = opponent(stm)
+            count = np.zeros(shape, dtype=np.int8)
+            captured = np.zeros(shape, dtype=bool)
+            win = np.zeros(shape, dtype=np.int16)
+            loss = np.zeros(shape, dtype=np.int16)
+            draw = np.zeros(shape, dtype=bool)
+
+            for i, dest, valid in moves(pieces, stm):
+                legal = valid & ~take_child(illegal[other], i, dest)
+                np.add(count, legal, out=count, casting='unsafe')
+
+                for j, (color, kind) in enumerate(pieces):
+                    if color == stm or kind == KING:
+                        continue
+                    capture = valid & expand(dest[:, None] == SQUARES[None, :], n, (i, j))
+                    if not capture.any():
+                        continue
+                    # Таблица после взятия хранится целиком, поворачивать не нужно
+                    sub_values, sub_illegal = self.sub_table(pieces[:j] + pieces[j + 1:], other)
+                    axis = i if i < j else i - 1
+                    child = np.expand_dims(np.take(sub_values, dest, axis=axis)[TRIANGLE], j)
+                    capture = capture & ~np.expand_dims(np.take(sub_illegal, dest, axis=axis)[TRIANGLE], j)
+
+                    captured |= capture
+                    # Соперник проигрывает: мат на полуход позже, чем у него
+                    wins = capture & (child < 0)
+                    win = np.where(wins & ((win == 0) | (-child < win)), -child, win).astype(np.int16)
+                    loss = np.maximum(loss, np.where(capture & (child > 0), child + 1, 0)).astype(np.int16)
+                    draw |= capture & (child == 0)
+
+            counts.append(count)
+            has_capture.append(captured)
+            capture_win.append(win)
+            capture_loss.append(loss)
+            capture_draw.append(draw)
+
+        values = [np.zeros(shape, dtype=np.int16) for _ in (WHITE, BLACK)]
+        for stm in (WHITE, BLACK):
+            # Без ходов позиция проиграна (как в ChessBoard.is_checkmate)
+            values[stm][~illegal[stm] & (counts[stm] == 0) & ~has_capture[stm]] = -1
+
+        # На полуходе ply находятся выигрыши (нечётный ply) или проигрыши
+        # (чётный) ровно за ply полуходов: выигрыш --- есть ход в позицию,
+        # проигранную сопернику за ply - 1, проигрыш --- все ходы ведут в
+        # выигранные соперником позиции, последняя из них --- за ply - 1
+        wins_count = [np.zeros(shape, dtype=np.int8) for _ in (WHITE, BLACK)]
+        pending = max(int(array.max()) for array in capture_win + capture_loss)
+        longest = 0
+        ply = 0
+        quiet = 0
+        while quiet < 2 or ply <= pending:
+            ply += 1
+            if ply > MAX_PLIES:
+                raise ValueError(f'{name}: мат длиннее {MAX_PLIES} полуходов не помещается в таблицу')
+
+            target = -ply if ply % 2 else ply - 1
+            hits = [values[stm] == target for stm in (WHITE, BLACK)]
+            found = False
+            for stm in (WHITE, BLACK):
+                other = opponent(stm)
+                unknown = (values[stm] == 0) & ~illegal[stm]
+                if ply % 2:
+                    new = capture_win[stm] == ply
+                    if hits[other].any():
+                        for i, dest, valid in moves(pieces, stm):
+                            new |= valid & take_child(hits[other], i, dest)
+                    new &= unknown
+                    values[stm][new] = ply
+                else:
+                    if hits[other].any():
+                        for i, dest, valid in moves(pieces, stm):
+                            np.add(wins_count[stm], valid & take_child(hits[other], i, dest),
+                                   out=wins_count[stm], casting='unsafe')
+                    new = (unknown & (wins_count[stm] == counts[stm]) & ~capture_draw[stm]
+                           & (capture_win[stm] == 0) & (capture_loss[stm] <= ply))
+                    values[stm][new] = -ply - 1
+                if new.any():
+                    found = True
+                    longest = ply
+            quiet = 0 if found else quiet + 1
+
+        if self.verbose:
+            print(f'{name}: longest mate {longest} plies, {time.perf_counter() - start:.1f} s')
+        return values, illegal
+
+    def save(self, name, values, illegal):
+        os.makedirs(self.directory, exist_ok=True)
+        data = []
+        for stm in (WHITE, BLACK):
+            codes = np.where(values[stm] > 0, values[stm], np.where(values[stm] < 0, 1 - values[stm], 0))
+            data.append(np.where(illegal[stm], ILLEGAL, codes).astype(np.uint8))
+        np.stack(data).tofile(self.path(name))
+
+    def load(self, name):
+        n = len(name)
+        data = np.fromfile(self.path(name), dtype=np.uint8).reshape((2,) + positions_shape(n))
+
+        codes = np.empty((2,) + (64,) * n, dtype=np.uint8)
+        for sq in range(64):
+            transform = TRANSFORMS[KING_TRANSFORM[sq]]
+            index = (slice(None), TRIANGLE_INDEX[transform[sq]]) + np.ix_(*[transform] * (n - 1))
+            codes[:, sq] = data[index]
+
+        illegal = codes == ILLEGAL
+        values = np.where(codes % 2 == 1, codes, np.where(codes > 0, 1 - codes.astype(np.int16), 0))
+        values = np.where(illegal, 0, values).astype(np.int16)
+        return [values[WHITE], values[BLACK]], [illegal[WHITE], illegal[BLACK]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Построение таблиц окончаний ретроградным анализом')
+    parser.add_argument('materials', nargs='*', default=MATERIALS,
+                        help='наборы фигур вида KRRK или KQKR (по умолчанию все до 4 фигур)')
+    parser.add_argument('-o', '--output', default=TABLEBASE_PATH)
+    args = parser.parse_args()
+
+    generator = Generator(args.output)
+    for name in args.materials:
+        generator.build(name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import struct
+
+# Тип оценки в записи таблицы
+EXACT, LOWER, UPPER = 1, 2, 3
+
+# Запись --- два 64-битных числа: (ключ ^ данные, данные). Если запись
+# перезаписана не полностью (например, другим процессом), ключ не сойдётся.
+# Данные: биты 0-12 --- ход (0 --- нет хода, иначе 1 + from * 64 + to),
+# 13-20 --- глубина, 21-22 --- тип оценки, 23-30 --- поколение поиска,
+# 32-63 --- оценка со сдвигом SCORE_OFFSET
+ENTRY = struct.Struct('<QQ')
+ENTRY_SIZE = ENTRY.size
+# В корзине две записи: первая заменяется только более глубокой
+# (или устаревшей) записью, вторая --- всегда
+BUCKET_SIZE = 2 * ENTRY_SIZE
+
+SCORE_OFFSET = 1 << 31
+MAX_DEPTH = 255
+MAX_AGE = 256
+
+
+def encode_move(move):
+    if move is None:
+        return 0
+    row, col, row1, col1 = move
+    return 1 + (row * 8 + col) * 64 + row1 * 8 + col1
+
+
+def decode_move(code):
+    if code == 0:
+        return None
+    code -= 1
+    src, dst = code // 64, code % 64
+    return src // 8, src % 8, dst // 8, dst % 8
+
+
+class TranspositionTable:
+    """Таблица уже посчитанных позиций фиксированного размера. Ключ ---
+    ChessBoard.zobrist_key(), значение --- глубина, оценка, её тип
+    (EXACT/LOWER/UPPER) и лучший ход. buffer позволяет разместить таблицу
+    в заранее выделенной памяти (например, общей для нескольких процессов)"""
+
+    def __init__(self, size_mb=16, buffer=None):
+        if buffer is None:
+            buffer = bytearray(max(1, int(size_mb * 1024 * 1024) // BUCKET_SIZE) * BUCKET_SIZE)
+        self.buffer = buffer
+        self.buckets = len(buffer) // BUCKET_SIZE
+        self.age = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+        self.stores = 0
+
+    def clear(self):
+        self.buffer[:self.buckets * BUCKET_SIZE] = bytes(self.buckets * BUCKET_SIZE)
+        self.age = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = self.misses = self.collisions = self.stores = 0
+
+    def new_search(self):
+        """Начать новое поколение: записи прошлых поисков заменяются в первую очередь"""
+        self.age = (self.age + 1) % MAX_AGE
+
+    def probe(self, key):
+        """Запись для позиции с ключом key: (глубина, оценка, тип оценки, ход) или None"""
+        offset = (key % self.buckets) * BUCKET_SIZE
+        occupied = False
+        for slot in (offset, offset + ENTRY_SIZE):
+            stored, data = ENTRY.unpack_from(self.buffer, slot)
+            if data == 0:
+                continue
+            if stored ^ data == key:
+                self.hits += 1
+                return (data >> 13 & 0xFF, (data >> 32) - SCORE_OFFSET, data >> 21 & 3,
+                        decode_move(data & 0x1FFF))
+            occupied = True
+
+        self.misses += 1
+        if occupied:
+            # В корзине лежат записи других позиций
+            self.collisions += 1
+        return None
+
+    def store(self, key, depth, score, bound, move=None):
+        offset = (key % self.buckets) * BUCKET_SIZE
+        data = (encode_move(move) | min(depth, MAX_DEPTH) << 13 | bound << 21 | self.age << 23
+                | (score + SCORE_OFFSET) << 32)
+
+        stored, old = ENTRY.unpack_from(self.buffer, offset)
+        if (old == 0 or stored ^ old == key or depth >= (old >> 13 & 0xFF)
+                or (old >> 23 & 0xFF) != self.age):
+            slot = offset
+        else:
+            slot = offset + ENTRY_SIZE
+
+        ENTRY.pack_into(self.buffer, slot, key ^ data, data)
+        self.stores += 1
+
+    def hashfull(self):
+        """Доля (в тысячных) первых 1000 корзин, занятых записями текущего поиска"""
+        count = min(self.buckets, 1000)
+        used = 0
+        for i in range(count):
+            for slot in (i * BUCKET_SIZE, i * BUCKET_SIZE + ENTRY_SIZE):
+                data = ENTRY.unpack_from(self.buffer, slot)[1]
+                if data and (data >> 23 & 0xFF) == self.age:
+                    used += 1
+        return used * 1000 // (2 * count)
+
+    def stats(self):
+        probes = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'collisions': self.collisions,
+            'stores': self.stores,
+            'hit_rate': self.hits / probes if probes else 0.0,
+            'hashfull': self.hashfull()
+        }
@@ -0,0 +1,12 @@
+import random
+
+# Зерно фиксировано, чтобы ключи позиций не менялись между запусками:
+# они сохраняются в дебютной книге (book.py)
+_random = random.Random(0x5EED_C4E55)
+
+# PIECE_KEYS[color][kind][sq]
+PIECE_KEYS = [[[_random.getrandbits(64) for _ in range(64)] for _ in range(6)] for _ in range(2)]
+# Ключ ещё не ходившей ладьи или короля в клетке sq (право на рокировку)
+UNMOVED_KEYS = [_random.getrandbits(64) for _ in range(64)]
+# Ход чёрных
+SIDE_KEY = _random.getrandbits(64)